@@ -3,10 +3,15 @@
 Configuración centralizada para el agente de análisis de datos
 """
 import os
+import functools
 from dotenv import load_dotenv
 
-# Cargar variables de entorno desde .env
-load_dotenv()
+# Cargar variables de entorno desde .env (una sola vez por árbol de procesos).
+# El sentinel se hereda en subprocesos/workers, que así no vuelven a parsear .env.
+# En CI/Docker con el entorno ya inyectado basta con exportar EVODATA_ENV_LOADED=1.
+if not os.getenv("EVODATA_ENV_LOADED"):
+    load_dotenv(override=False)
+    os.environ["EVODATA_ENV_LOADED"] = "1"
 
 # ========================================
 # 🗄️ DATABASE CONFIGURATION (PostgreSQL)
@@ -31,7 +36,34 @@ DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NA
 # ========================================
 EVOLUTION_URL = os.getenv("EVOLUTION_URL", "https://evoapi.tbrflows.transborder.com.co")
 EVOLUTION_INSTANCE = os.getenv("EVOLUTION_INSTANCE", "test")
-EVOLUTION_API_KEY = os.getenv("EVOLUTION_API_KEY", "9447C9B9D3FD-4F9B-A45C-0CF64D12EDC3")
+EVOLUTION_API_KEY = os.getenv("EVOLUTION_API_KEY")  # Secreto: solo desde entorno/.env
+
+# Connection pool (keep-alive) para el cliente HTTP de EvolutionAPI
+EVOLUTION_MAX_CONNECTIONS = int(os.getenv("EVOLUTION_MAX_CONNECTIONS", "100"))
+EVOLUTION_MAX_KEEPALIVE = int(os.getenv("EVOLUTION_MAX_KEEPALIVE", "10"))
+EVOLUTION_CONNECT_RETRIES = int(os.getenv("EVOLUTION_CONNECT_RETRIES", "3"))
+EVOLUTION_CONNECT_TIMEOUT = float(os.getenv("EVOLUTION_CONNECT_TIMEOUT", "3"))  # seconds
+EVOLUTION_READ_TIMEOUT = float(os.getenv("EVOLUTION_READ_TIMEOUT", "60"))  # seconds (uploads de media)
+EVOLUTION_HTTP2 = os.getenv("EVOLUTION_HTTP2", "false").lower() == "true"  # requiere httpx[http2]
+
+# Reintentos ante 429/5xx transitorios (backoff exponencial + Retry-After)
+EVOLUTION_MAX_RETRIES = int(os.getenv("EVOLUTION_MAX_RETRIES", "3"))
+EVOLUTION_RETRY_BACKOFF = float(os.getenv("EVOLUTION_RETRY_BACKOFF", "1.0"))  # seconds
+
+# Límite de envíos por segundo hacia la instancia (token bucket, 0 = sin límite)
+EVOLUTION_MAX_RPS = float(os.getenv("EVOLUTION_MAX_RPS", "20"))
+
+# Concurrencia adaptativa (AIMD) de envíos simultáneos
+EVOLUTION_MAX_CONCURRENCY = int(os.getenv("EVOLUTION_MAX_CONCURRENCY", "64"))
+EVOLUTION_LATENCY_TARGET = float(os.getenv("EVOLUTION_LATENCY_TARGET", "10"))  # seconds
+
+# Cola de envíos en segundo plano (fire-and-forget) y número de workers
+EVOLUTION_SEND_QUEUE_SIZE = int(os.getenv("EVOLUTION_SEND_QUEUE_SIZE", "1000"))
+EVOLUTION_SEND_WORKERS = int(os.getenv("EVOLUTION_SEND_WORKERS", "4"))
+
+# Adjuntos como multipart (bytes crudos, sin base64). Requiere soporte en la instancia;
+# si la instancia lo rechaza se vuelve automáticamente a base64.
+EVOLUTION_MULTIPART_MEDIA = os.getenv("EVOLUTION_MULTIPART_MEDIA", "false").lower() == "true"
 
 # ========================================
 # 🔗 MCP SERVER CONFIGURATION
@@ -77,11 +109,30 @@ COLOR_PALETTE_PRIMARY = ["#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd",
 # 📁 FILE PATHS
 # ========================================
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-TEMP_DIR = os.path.join(BASE_DIR, "temp")
-EXPORTS_DIR = os.path.join(BASE_DIR, "exports")
-LOGS_DIR = os.path.join(BASE_DIR, "logs")
-
-# NOTE: Los directorios se inicializan en el startup del servidor para evitar efectos secundarios en config.
+# Sobrescribibles por entorno: p.ej. TEMP_DIR/EXPORTS_DIR en tmpfs (/dev/shm) para artefactos efímeros
+TEMP_DIR = os.getenv("TEMP_DIR", os.path.join(BASE_DIR, "temp"))
+EXPORTS_DIR = os.getenv("EXPORTS_DIR", os.path.join(BASE_DIR, "exports"))
+LOGS_DIR = os.getenv("LOGS_DIR", os.path.join(BASE_DIR, "logs"))
+
+# NOTE: Los directorios NO se crean al importar config (sin efectos secundarios).
+# Se crean en el primer uso vía los getters (una sola vez por proceso gracias a lru_cache).
+@functools.lru_cache(maxsize=None)
+def get_temp_dir() -> str:
+    """Directorio de temporales (audios), creado en el primer uso"""
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    return TEMP_DIR
+
+@functools.lru_cache(maxsize=None)
+def get_exports_dir() -> str:
+    """Directorio de exports (gráficos, Excel), creado en el primer uso"""
+    os.makedirs(EXPORTS_DIR, exist_ok=True)
+    return EXPORTS_DIR
+
+@functools.lru_cache(maxsize=None)
+def get_logs_dir() -> str:
+    """Directorio de logs y memoria de sesiones, creado en el primer uso"""
+    os.makedirs(LOGS_DIR, exist_ok=True)
+    return LOGS_DIR
 
 # ========================================
 # 🔐 SECURITY SETTINGS
@@ -95,10 +146,11 @@ RATE_LIMIT_WINDOW = int(os.getenv("RATE_LIMIT_WINDOW", "60"))  # seconds
 
 
 # Forbidden SQL keywords (blacklist for destructive operations)
-FORBIDDEN_SQL_KEYWORDS = [
+# frozenset: membership O(1) e inmutable
+FORBIDDEN_SQL_KEYWORDS = frozenset({
     "DROP", "DELETE", "TRUNCATE", "ALTER", "CREATE", "INSERT", "UPDATE",
     "GRANT", "REVOKE", "EXEC", "EXECUTE", "CALL"
-]
+})
 
 # ========================================
 # 📝 LOGGING CONFIGURATION
@@ -112,14 +164,39 @@ LOG_BACKUP_COUNT = 5
 # 🌐 FILE DELIVERY SETTINGS
 # ========================================
 # FILE_DELIVERY_METHOD can be: "both", "attachment", "url"
-FILE_DELIVERY_METHOD = os.getenv("FILE_DELIVERY_METHOD", "both")
+FILE_DELIVERY_METHODS = ("attachment", "url", "both")
+FILE_DELIVERY_METHOD = os.getenv("FILE_DELIVERY_METHOD", "attachment").strip().lower()
+if FILE_DELIVERY_METHOD not in FILE_DELIVERY_METHODS:
+    # Un valor desconocido no enviaría ni enlaces ni adjuntos: fallar al arrancar
+    raise ValueError(
+        f"FILE_DELIVERY_METHOD inválido: '{FILE_DELIVERY_METHOD}' (usar: {', '.join(FILE_DELIVERY_METHODS)})"
+    )
+FILE_DELIVERY_LINKS = FILE_DELIVERY_METHOD in ("url", "both")
+FILE_DELIVERY_ATTACHMENTS = FILE_DELIVERY_METHOD in ("attachment", "both")
 FILE_SERVER_URL = os.getenv("FILE_SERVER_URL", "http://localhost:8001/exports")
 
+# MIME por extensión de los archivos que genera el agente (lookup O(1), sin mimetypes)
+EXPORT_MIME_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ".csv": "text/csv",
+    ".pdf": "application/pdf",
+    ".txt": "text/plain",
+    ".mp3": "audio/mpeg",
+}
+
+# Extensiones de exports que se adjuntan automáticamente a la respuesta
+EXPORT_ATTACHMENT_SUFFIXES = frozenset({".png", ".jpg", ".jpeg", ".xlsx", ".csv", ".pdf"})
+
 # ========================================
 # 🔌 SERVER PORTS
 # ========================================
 WEBHOOK_SERVER_PORT = int(os.getenv("WEBHOOK_SERVER_PORT", "5000"))
 FILE_SERVER_PORT = int(os.getenv("FILE_SERVER_PORT", "8001"))
+# Orígenes permitidos (CORS) para descargar exports desde navegador, separados por coma
+CORS_ALLOWED_ORIGINS = [o.strip() for o in os.getenv("CORS_ALLOWED_ORIGINS", "*").split(",") if o.strip()]
 
 # ========================================
 # 🧠 AGENT BEHAVIOR
@@ -129,6 +206,24 @@ AGENT_VERSION = "1.0.0"
 DEFAULT_LANGUAGE = "es"  # Spanish
 RESPONSE_TIMEOUT = int(os.getenv("RESPONSE_TIMEOUT", "60"))  # seconds
 
+# Sesiones de memoria (SQLite) abiertas a la vez; las menos usadas se cierran
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "512"))
+# Archivos SQLite de memoria compartidos (usuarios repartidos por hash); 0 = un archivo por usuario
+MEMORY_DB_SHARDS = int(os.getenv("MEMORY_DB_SHARDS", "64"))
+# Números cuya memoria se abre al arrancar (separados por coma, formato @c.us)
+WARMUP_PHONE_NUMBERS = [p.strip() for p in os.getenv("WARMUP_PHONE_NUMBERS", "").split(",") if p.strip()]
+
+# Deduplicación de webhooks: EvolutionAPI puede reenviar el mismo mensaje
+WEBHOOK_DEDUP_TTL = int(os.getenv("WEBHOOK_DEDUP_TTL", "3600"))  # seconds (0 = desactivado)
+WEBHOOK_DEDUP_MAX_ENTRIES = int(os.getenv("WEBHOOK_DEDUP_MAX_ENTRIES", "10000"))
+
+# Caché de respuestas por usuario (misma pregunta normalizada dentro del TTL; 0 = desactivada)
+# Las preguntas con referencias temporales ("hoy", "último", ...) nunca se cachean.
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "0"))  # seconds
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+# Mínimo de palabras para cachear: los mensajes cortos ("sí", "ok", "y en marzo?") dependen del contexto
+RESPONSE_CACHE_MIN_WORDS = int(os.getenv("RESPONSE_CACHE_MIN_WORDS", "4"))
+
 
 # ========================================
 # 📊 EXCEL EXPORT DEFAULTS
@@ -12,7 +12,8 @@ echo "============================================"
 
 # Iniciar File Server en background
 echo "📂 Starting File Server (Background)..."
-python file_server.py &
+# uvicorn directo (igual que el webhook): sin el recargador de DEBUG_MODE en el contenedor
+uvicorn file_server:app --host 0.0.0.0 --port "${FILE_SERVER_PORT:-8001}" &
 FILE_SERVER_PID=$!
 
 # Iniciar Webhook Server en foreground
@@ -3,27 +3,105 @@
 Orquestador principal basado en el SDK oficial de OpenAI Agents.
 Cumplimiento 100% con SOLID y Clean Code.
 """
-import uuid
+from uuid import uuid4
+import asyncio
 import os
-import time
+import re
+from collections import OrderedDict
+from hashlib import blake2b
 from typing import Dict, Any, Optional, List
 from pathlib import Path
 from pydantic import BaseModel
 
-from agents import Agent, Runner
+from agents import Agent, Runner, ToolCallOutputItem
 from agents.mcp import MCPServerSse, MCPServerSseParams
+from mcp.shared.exceptions import McpError
 import config
-from utils.logger import get_logger
+from utils.logger import get_logger, log_error_with_context
 from utils.whisper_util import transcribe_audio
 from agents.memory import SQLiteSession
+from services.tts_service import get_tts_service
+from services.response_cache import get_response_cache
 
 # Herramientas Core (Visualización y Reportes)
-from tools.visualizer import generate_chart
-from tools.excel_generator import generate_excel_report
+from tools.visualizer import generate_chart, ChartResult
+from tools.excel_generator import generate_excel_report, ExcelResult
 from tools.calculator import calculate_expression
 
 logger = get_logger("EvoDataAgent")
 
+# Prompt del agente: se construye una sola vez al importar el módulo
+_INSTRUCTIONS = (
+    f"Eres {config.AGENT_NAME}, el analista de datos oficial de M.C.T. SAS. "
+    "Tu misión es proporcionar insights profesionales sobre cualquier base de datos conectada vía MCP. "
+    "\n\nESTRATEGIA:"
+    "\n1. Explora las herramientas disponibles en el servidor MCP para entender qué datos puedes consultar (ventas, stock, clientes, etc.)."
+    "\n2. Ejecuta consultas SQL SELECT precisas según la necesidad del usuario."
+    "\n3. Genera gráficas o excels según la solicitud del usuario usando tus herramientas locales."
+    "\n4. Sé profesional y estructurado en español."
+)
+
+# Tabla para plegar acentos en una sola pasada C (str.translate): "gráfico" == "grafico"
+_ACCENT_TABLE = str.maketrans("áéíóúüÁÉÍÓÚÜñÑ", "aeiouuAEIOUUnN")
+
+# Palabras que indican que la respuesta habla de archivos generados (sin acentos, una sola pasada regex)
+_FILE_MENTION_KEYWORDS = ("chart", "excel", "grafic", "reporte", "archivo")
+_FILE_MENTION_PATTERN = re.compile("|".join(map(re.escape, _FILE_MENTION_KEYWORDS)), re.IGNORECASE)
+
+def _memory_db_path(phone_number: str) -> str:
+    """
+    Archivo SQLite de la memoria del usuario.
+    SQLiteSession guarda session_id en cada fila, así que varios usuarios comparten
+    un shard (memory_shard_NN.db) sin mezclarse. Los usuarios con un archivo propio
+    previo (memory_<numero>.db) lo siguen usando para no perder su historial.
+    """
+    logs_dir = config.get_logs_dir()
+    legacy_path = os.path.join(logs_dir, f"memory_{phone_number}.db")
+    if config.MEMORY_DB_SHARDS <= 0 or os.path.exists(legacy_path):
+        return legacy_path
+    shard = int.from_bytes(blake2b(phone_number.encode(), digest_size=2).digest(), "big") % config.MEMORY_DB_SHARDS
+    return os.path.join(logs_dir, f"memory_shard_{shard:02d}.db")
+
+def _raised_by_mcp_transport(error: BaseException) -> bool:
+    """True si la excepción se originó dentro del cliente MCP (sesión/transporte SSE del paquete `mcp`)"""
+    tb = error.__traceback__
+    while tb is not None:
+        module = tb.tb_frame.f_globals.get("__name__", "")
+        if module == "mcp" or module.startswith("mcp."):
+            return True
+        tb = tb.tb_next
+    return False
+
+def _is_mcp_error(error: BaseException) -> bool:
+    """
+    True si el error proviene de la conexión MCP (sesión SSE caída tras reiniciar el servidor).
+    Solo cuentan McpError y lo lanzado por el transporte MCP: un fallo de OpenAI
+    (p.ej. APIConnectionError) no debe marcar como caída la conexión compartida.
+    """
+    while error is not None:
+        if isinstance(error, McpError) or _raised_by_mcp_transport(error):
+            return True
+        error = error.__cause__
+    return False
+
+def _remove_voice_file(task: "asyncio.Task") -> None:
+    """Callback de una tarea TTS descartada: consume su resultado/excepción y borra el audio si llegó a generarse"""
+    if task.cancelled() or task.exception() is not None:
+        return
+    voice_path = task.result()
+    if voice_path:
+        Path(voice_path).unlink(missing_ok=True)
+
+def discard_voice_task(task: Optional["asyncio.Task"]) -> None:
+    """
+    Descarta una síntesis de voz que ya no se va a enviar (error en el flujo antes del seguimiento).
+    La cancela y, si ya había terminado, borra su archivo; sin avisos de "Task exception was never retrieved".
+    """
+    if task is None:
+        return
+    task.cancel()
+    task.add_done_callback(_remove_voice_file)
+
 class EvoDataAgent:
     """
     Agente experto en Análisis de Datos de M.C.T. SAS.
@@ -37,21 +115,15 @@ class EvoDataAgent:
             params=MCPServerSseParams(
                 url=config.MCP_SERVER_URL,
                 timeout=30.0
-            )
+            ),
+            # El catálogo de tools del servidor es estático: sin list_tools por cada Runner.run
+            cache_tools_list=True
         )
 
         # Definición del Agente Nativo
         self.agent = Agent(
             name=config.AGENT_NAME,
-            instructions=(
-                f"Eres {config.AGENT_NAME}, el analista de datos oficial de M.C.T. SAS. "
-                "Tu misión es proporcionar insights profesionales sobre cualquier base de datos conectada vía MCP. "
-                "\n\nESTRATEGIA:"
-                "\n1. Explora las herramientas disponibles en el servidor MCP para entender qué datos puedes consultar (ventas, stock, clientes, etc.)."
-                "\n2. Ejecuta consultas SQL SELECT precisas según la necesidad del usuario."
-                "\n3. Genera gráficas o excels según la solicitud del usuario usando tus herramientas locales."
-                "\n4. Sé profesional y estructurado en español."
-            ),
+            instructions=_INSTRUCTIONS,
             model=config.CHAT_MODEL,
             mcp_servers=[self.mcp_server],
             tools=[
@@ -60,18 +132,72 @@ class EvoDataAgent:
                 calculate_expression
             ]
         )
-        # Memoria persistente basada en SQLite
-        self.sessions: Dict[str, SQLiteSession] = {}
+        # Estado de la conexión MCP: se conecta una vez y se reutiliza hasta un error de conexión
+        self._mcp_ready = asyncio.Event()
+        self._mcp_lock = asyncio.Lock()
+        
+        # Memoria persistente basada en SQLite (LRU acotado: cierra las sesiones menos usadas)
+        self.sessions: "OrderedDict[str, SQLiteSession]" = OrderedDict()
         
         # TTS Service para respuestas de voz
-        from services.tts_service import get_tts_service
         self.tts = get_tts_service()
         
+        # Caché de respuestas (RESPONSE_CACHE_TTL=0 la desactiva)
+        self.response_cache = get_response_cache()
+        
         logger.info(f" Agente '{config.AGENT_NAME}' inicializado con soporte de Memoria{' + TTS' if self.tts.enabled else ''}")
 
+    async def warmup(self, known_users: Optional[List[str]] = None):
+        """
+        Calienta recursos fuera del camino del usuario (llamar al arrancar el servidor):
+        conexión MCP y sesiones de memoria de usuarios conocidos.
+        """
+        try:
+            await self._ensure_mcp_connected()
+            if self._mcp_ready.is_set():
+                tools = await self.mcp_server.list_tools()  # llena la caché de tools
+                logger.info("🧰 %d tools MCP en caché", len(tools))
+            for phone_number in known_users or []:
+                session = self._get_session(phone_number)
+                await session.get_items(limit=1)  # abre el archivo SQLite y su esquema
+            logger.info(
+                "🔥 Warmup completo (MCP: %s, sesiones: %d)",
+                "ok" if self._mcp_ready.is_set() else "pendiente", len(known_users or [])
+            )
+        except Exception as e:
+            logger.warning("⚠️ Warmup incompleto, se reintentará con el primer mensaje: %s", e)
+
     async def _ensure_mcp_connected(self):
         """
         Garantiza que la conexión MCP esté activa antes de procesar.
+        Camino rápido: si ya está conectada no hay round-trip; el lock evita que
+        varios mensajes simultáneos conecten a la vez.
+        """
+        if self._mcp_connected():
+            return
+        async with self._mcp_lock:
+            if self._mcp_connected():
+                return
+            self._mcp_ready.clear()
+            if await self._connect_mcp():
+                self._mcp_ready.set()
+
+    def _mcp_connected(self) -> bool:
+        """True si la conexión MCP está marcada como activa y el SDK conserva su sesión"""
+        return self._mcp_ready.is_set() and self.mcp_server.session is not None
+
+    def _reset_mcp(self):
+        """
+        Marca la conexión MCP como caída: el próximo mensaje reconecta bajo _mcp_lock.
+        No cierra la sesión actual: el MCPServerSse es compartido y otras solicitudes
+        pueden seguir usándola.
+        """
+        self._mcp_ready.clear()
+        self.mcp_server.invalidate_tools_cache()
+
+    async def _connect_mcp(self) -> bool:
+        """
+        Conecta al servidor MCP. Retorna True si la conexión quedó activa.
         Maneja reconexión y fallback inteligente de hosts de forma robusta.
         """
         try:
@@ -79,8 +205,9 @@ class EvoDataAgent:
             params = self.mcp_server.params
             current_url = getattr(params, "url", None) or (params.get("url") if isinstance(params, dict) else None)
             
-            logger.info(f"📡 Verificando conexión MCP a {current_url}...")
+            logger.info(f"📡 Conectando a MCP en {current_url}...")
             await self.mcp_server.connect()
+            return True
         except Exception as e:
             error_msg = str(e)
             logger.warning(f"⚠️ Primer intento de conexión falló: {error_msg}")
@@ -103,15 +230,16 @@ class EvoDataAgent:
                     logger.info(f"📡 Reintentando conexión a {new_url}...")
                     await self.mcp_server.connect()
                     logger.info(f"✅ Conexión exitosa usando fallback: {new_url}")
-                    return
+                    return True
                 except Exception as e2:
                     logger.error(f"❌ Falló también el fallback a localhost: {e2}")
             
             # Si el error sugiere que ya está conectado, lo ignoramos
             if "already connected" in error_msg.lower() or "connection is active" in error_msg.lower():
                  logger.debug("Info: Ya estaba conectado.")
-            else:
-                 logger.error(f"❌ Error crítico conectando a MCP: {e}")
+                 return True
+            logger.error(f"❌ Error crítico conectando a MCP: {e}")
+            return False
 
     async def process_message(
         self,
@@ -123,87 +251,159 @@ class EvoDataAgent:
         """
         Procesa el mensaje usando el Runner del SDK.
         No usa MessageProcessor (Redundante); usa Whisper directamente si es voz.
+        
+        Si el usuario envió voz, el resultado incluye "voice_task": la síntesis TTS sigue
+        en curso y resuelve al path de la nota de voz (o None). El llamador responde con
+        el texto sin esperarla y envía la nota como seguimiento.
         """
-        request_id = str(uuid.uuid4())
-        attachments = []
+        request_id = uuid4().hex
+        voice_task = None
         
         try:
-            # 0. Asegurar Conexión MCP (Fix: Server not initialized)
-            await self._ensure_mcp_connected()
+            # Validación barata primero: un texto vacío no necesita MCP
+            if not is_voice and (not message or not message.strip()):
+                return {"success": False, "error": "Mensaje vacío", "request_id": request_id}
 
-            # 0.1 Capturar archivos existentes ANTES de procesar (método robusto)
-            exports_dir = Path(config.EXPORTS_DIR)
-            files_before: Dict[str, float] = {}
-            if exports_dir.exists():
-                for f in exports_dir.iterdir():
-                    if f.is_file():
-                        files_before[f.name] = f.stat().st_mtime
-            
-            timestamp_before = time.time()
+            # Texto repetido: responder desde caché sin MCP ni LLM
+            if not is_voice:
+                cached = await self._cached_response(message, phone_number, is_voice, request_id)
+                if cached:
+                    return cached
 
-            # 1. Voz a Texto (Si aplica)
+            # 0. Asegurar Conexión MCP (Fix: Server not initialized)
+            # 1. Voz a Texto (Si aplica): Whisper y el handshake MCP no dependen entre sí, van en paralelo
             if is_voice and audio_path:
-                message = await transcribe_audio(audio_path)
+                connect_task = asyncio.create_task(self._ensure_mcp_connected())
+                try:
+                    message = await transcribe_audio(audio_path)
+                finally:
+                    await connect_task
+            else:
+                await self._ensure_mcp_connected()
             
             if not message or not message.strip():
                 return {"success": False, "error": "Mensaje vacío", "request_id": request_id}
 
-            logger.info(f"📩 [{phone_number}] -> {message[:50]}...")
+            if is_voice:
+                cached = await self._cached_response(message, phone_number, is_voice, request_id)
+                if cached:
+                    return cached
+
+            logger.info("📩 [%s] -> %.50s...", phone_number, message)
             
             # 2. Obtener o crear sesión para el usuario (Memoria)
-            if phone_number not in self.sessions:
-                db_path = f"logs/memory_{phone_number}.db"
-                self.sessions[phone_number] = SQLiteSession(session_id=phone_number, db_path=db_path)
-            
-            session = self.sessions[phone_number]
+            session = self._get_session(phone_number)
 
             # 3. Ejecutar Runner del SDK con Memoria
             result = await Runner.run(self.agent, message, session=session)
             
-            # 4. Detectar archivos NUEVOS en exports (método robusto)
-            # Comparar archivos antes y después - detecta cualquier archivo nuevo o modificado
-            if exports_dir.exists():
-                for file_path in exports_dir.iterdir():
-                    if file_path.is_file():
-                        file_name = file_path.name
-                        file_mtime = file_path.stat().st_mtime
-                        
-                        # Archivo nuevo o modificado después de timestamp_before
-                        is_new = file_name not in files_before
-                        is_modified = file_mtime > timestamp_before
-                        
-                        if is_new or is_modified:
-                            # Solo incluir archivos típicos de exportación
-                            if file_path.suffix.lower() in ['.png', '.jpg', '.jpeg', '.xlsx', '.csv', '.pdf']:
-                                attachments.append(str(file_path))
-                                logger.info(f"📎 Archivo detectado: {file_path}")
+            # TTS en paralelo con el post-proceso (la síntesis es un round-trip a ElevenLabs).
+            # Solo aplica si el usuario envió voz: los mensajes de texto no crean la tarea
+            voice_task = (
+                asyncio.create_task(self._generate_voice_response(result.final_output, True, request_id))
+                if is_voice else None
+            )
+            
+            # 4. Archivos generados en ESTA ejecución: salen directo de los resultados de las tools
+            # (sin escanear exports/ ni confundir archivos de otros usuarios concurrentes)
+            attachments = self._collect_attachments(result.new_items)
             
+            self.response_cache.put(phone_number, message, result.final_output, attachments)
+
             # Log si no se detectaron archivos pero hay texto sobre archivos generados
             if not attachments:
                 output_text = result.final_output or ""
-                if any(kw in output_text.lower() for kw in ["chart", "excel", "gráfica", "grafica", "reporte", "archivo"]):
-                    logger.warning("⚠️ El agente menciona archivos pero no se detectaron en exports/")
+                if _FILE_MENTION_PATTERN.search(output_text.translate(_ACCENT_TABLE)):
+                    logger.warning("⚠️ El agente menciona archivos pero ninguna tool generó uno")
 
-            return {
+            response = {
                 "success": True,
                 "response": result.final_output,
                 "files": attachments,
-                "voice_note": await self._generate_voice_response(result.final_output, is_voice),
                 "request_id": request_id
             }
+            if voice_task:
+                response["voice_task"] = voice_task
+            return response
 
         except Exception as e:
-            from utils.logger import log_error_with_context
+            discard_voice_task(voice_task)
             log_error_with_context(logger, e, {"phone_number": phone_number, "request_id": request_id})
+            # Conexión MCP perdida (servidor reiniciado, sesión SSE vencida): reconectar en el próximo mensaje
+            if _is_mcp_error(e):
+                self._reset_mcp()
             return {"success": False, "error": str(e), "request_id": request_id}
     
-    async def _generate_voice_response(self, text: str, user_sent_voice: bool) -> Optional[str]:
+    def _get_session(self, phone_number: str) -> SQLiteSession:
+        """
+        Sesión de memoria del usuario desde el LRU.
+        Al superar MAX_SESSIONS cierra la menos usada (libera su conexión SQLite);
+        si el usuario vuelve, se reabre desde su archivo sin perder historial.
+        """
+        session = self.sessions.get(phone_number)
+        if session is not None:
+            self.sessions.move_to_end(phone_number)
+            return session
+        
+        session = SQLiteSession(session_id=phone_number, db_path=_memory_db_path(phone_number))
+        self.sessions[phone_number] = session
+        
+        while len(self.sessions) > config.MAX_SESSIONS:
+            old_phone, old_session = self.sessions.popitem(last=False)
+            try:
+                old_session.close()
+            except Exception as e:
+                logger.warning(f"⚠️ No se pudo cerrar la sesión de {old_phone}: {e}")
+        return session
+
+    def _collect_attachments(self, items: List[Any]) -> List[str]:
+        """Rutas de los gráficos/Excel que las tools generaron con éxito durante la ejecución"""
+        attachments = []
+        for item in items:
+            if not isinstance(item, ToolCallOutputItem):
+                continue
+            output = item.output
+            if isinstance(output, (ChartResult, ExcelResult)) and output.success and output.file_path:
+                if Path(output.file_path).suffix.lower() in config.EXPORT_ATTACHMENT_SUFFIXES:
+                    attachments.append(output.file_path)
+                    logger.info("📎 Archivo generado: %s", output.file_path)
+        return attachments
+
+    async def _cached_response(
+        self, message: str, phone_number: str, is_voice: bool, request_id: str
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Respuesta armada desde la caché si el usuario repitió una pregunta reciente.
+        El turno se registra en la memoria de la sesión igual que si hubiera pasado por el Runner.
+        """
+        cached = self.response_cache.get(phone_number, message)
+        if not cached:
+            return None
+        
+        response, files = cached
+        logger.info("🧠 [%s] Respuesta servida desde caché", phone_number)
+        await self._get_session(phone_number).add_items([
+            {"role": "user", "content": message},
+            {"role": "assistant", "content": response}
+        ])
+        result = {
+            "success": True,
+            "response": response,
+            "files": files,
+            "request_id": request_id
+        }
+        if is_voice:
+            result["voice_task"] = asyncio.create_task(self._generate_voice_response(response, True, request_id))
+        return result
+
+    async def _generate_voice_response(self, text: str, user_sent_voice: bool, request_id: str) -> Optional[str]:
         """
         Genera nota de voz si está habilitado y es apropiado.
         
         Args:
             text: Respuesta del agente en texto
             user_sent_voice: Si el usuario envió un mensaje de voz
+            request_id: ID de la solicitud (nombra el archivo y lo correlaciona con los logs)
         
         Returns:
             Path del archivo de audio generado, o None si no se generó
@@ -218,11 +418,11 @@ class EvoDataAgent:
                 response_text = response_text[:config.VOICE_RESPONSE_MAX_CHARS] + "..."
             
             # Generar audio
-            voice_path = Path(config.TEMP_DIR) / f"response_{uuid.uuid4().hex}.mp3"
+            voice_path = Path(config.get_temp_dir()) / f"response_{request_id}.mp3"
             
             success = await self.tts.text_to_speech(response_text, str(voice_path))
             if success:
-                logger.info(f"🎵 Nota de voz generada: {voice_path}")
+                logger.info("🎵 Nota de voz generada: %s", voice_path)
                 return str(voice_path)
             else:
                 return None
@@ -2,11 +2,17 @@
 🌐 File Server for EvoDataAgent (FastAPI)
 Sirve archivos exports (gráficos y Excel) vía HTTP
 """
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import FileResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
 from pathlib import Path
-from typing import List
+from typing import Any, Dict, List, Tuple
+import os
+import stat
+import time
 import config
 from utils.logger import get_logger
 
@@ -15,6 +21,9 @@ logger = get_logger("FileServer")
 # Directorio de exports
 EXPORTS_DIR = Path(config.EXPORTS_DIR)
 
+# Cache-Control de las descargas (los exports son inmutables: nombres únicos por archivo)
+_CACHE_CONTROL = "public, max-age=3600"
+
 # Crear aplicación FastAPI
 app = FastAPI(
     title="EvoDataAgent File Server",
@@ -23,18 +32,33 @@ app = FastAPI(
     docs_url="/docs"
 )
 
-# Configurar CORS
+# Configurar CORS: solo lectura (GET/HEAD) y preflights cacheados 24h por el navegador.
+# Sin credenciales: el comodín "*" con credenciales no es válido según la especificación.
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=config.CORS_ALLOWED_ORIGINS,
+    allow_credentials=False,
+    allow_methods=["GET", "HEAD"],
+    allow_headers=["If-None-Match", "If-Modified-Since"],
+    max_age=86400,
 )
 
 
+@lru_cache(maxsize=1)
+def _listing(bucket: int) -> Tuple[str, ...]:
+    """
+    Nombres de archivos en exports, cacheados por segundo (`bucket`): el polling repetido
+    no relista el directorio. scandir resuelve is_file() desde el buffer de readdir (sin stat extra).
+    """
+    try:
+        with os.scandir(EXPORTS_DIR) as entries:
+            return tuple(e.name for e in entries if e.is_file(follow_symlinks=False))
+    except FileNotFoundError:
+        return ()
+
+
 @app.get("/", tags=["Info"])
-async def root():
+async def root() -> Dict[str, Any]:
     """Información del servidor de archivos"""
     return {
         "name": "EvoDataAgent File Server",
@@ -45,8 +69,27 @@ async def root():
     }
 
 
+def _is_not_modified(request: Request, etag: str, mtime: float) -> bool:
+    """True si la copia del cliente sigue vigente (If-None-Match tiene prioridad sobre If-Modified-Since)"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return etag in tags or "*" in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            # Zona "-0000" (o sin zona): la fecha HTTP es UTC, no hora local del servidor
+            since = since.replace(tzinfo=timezone.utc)
+        return int(mtime) <= since.timestamp()
+    return False
+
+
 @app.get("/exports/{filename}", tags=["Files"])
-async def download_file(filename: str) -> FileResponse:
+async def download_file(filename: str, request: Request) -> Response:
     """
     Descarga un archivo del directorio de exports
     
@@ -56,33 +99,35 @@ async def download_file(filename: str) -> FileResponse:
     """
     file_path = EXPORTS_DIR / filename
     
-    # Verificar que el archivo existe
-    if not file_path.exists():
+    # Un solo stat: existencia, tipo, ETag y cabeceras de FileResponse salen del mismo resultado
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
         logger.warning(f"⚠️ Archivo no encontrado: {filename}")
         raise HTTPException(status_code=404, detail=f"Archivo '{filename}' no encontrado")
     
     # Verificar que es un archivo (no directorio)
-    if not file_path.is_file():
+    if not stat.S_ISREG(st.st_mode):
         logger.warning(f"⚠️ Ruta no es un archivo: {filename}")
         raise HTTPException(status_code=400, detail="La ruta especificada no es un archivo")
     
-    logger.info(f"📥 Sirviendo archivo: {filename}")
+    # Los exports no cambian una vez escritos: ETag por tamaño + mtime y 304 si el cliente ya lo tiene
+    etag = f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+    cache_headers = {"ETag": etag, "Cache-Control": _CACHE_CONTROL}
+    if _is_not_modified(request, etag, st.st_mtime):
+        return Response(status_code=304, headers=cache_headers)
     
-    # Determinar media_type según extensión
-    media_type = "application/octet-stream"
-    if filename.endswith('.png'):
-        media_type = "image/png"
-    elif filename.endswith('.jpg') or filename.endswith('.jpeg'):
-        media_type = "image/jpeg"
-    elif filename.endswith('.xlsx'):
-        media_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    elif filename.endswith('.pdf'):
-        media_type = "application/pdf"
+    logger.info("📥 Sirviendo archivo: %s", filename)
+    
+    # Determinar media_type según extensión (tabla compartida con el envío de adjuntos)
+    media_type = config.EXPORT_MIME_TYPES.get(file_path.suffix.lower(), "application/octet-stream")
     
     return FileResponse(
         path=str(file_path),
         filename=filename,
-        media_type=media_type
+        media_type=media_type,
+        headers=cache_headers,
+        stat_result=st
     )
 
 
@@ -93,17 +138,14 @@ async def list_files() -> List[str]:
     
     Útil para debugging y verificación
     """
-    if not EXPORTS_DIR.exists():
-        return []
-    
-    files = [f.name for f in EXPORTS_DIR.iterdir() if f.is_file()]
-    logger.info(f"📋 Listado de archivos solicitado: {len(files)} archivos")
+    files = list(_listing(int(time.monotonic())))
+    logger.info("📋 Listado de archivos solicitado: %d archivos", len(files))
     
     return files
 
 
 @app.get("/health", tags=["Monitoring"])
-async def health_check():
+async def health_check() -> Dict[str, Any]:
     """Health check endpoint"""
     exports_exists = EXPORTS_DIR.exists()
     
@@ -119,7 +161,7 @@ if __name__ == "__main__":
     import uvicorn
     
     # Asegurar que el directorio existe
-    EXPORTS_DIR.mkdir(exist_ok=True)
+    config.get_exports_dir()
     
     logger.info(f"🚀 Iniciando File Server (FastAPI) en puerto {config.FILE_SERVER_PORT}")
     logger.info(f"📁 Sirviendo archivos desde: {EXPORTS_DIR}")
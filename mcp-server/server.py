@@ -1,16 +1,18 @@
 import os
+import re
 import asyncio
 import logging
 import json
 from contextlib import asynccontextmanager
-from typing import Any, List
+from typing import Any, List, Optional
 
 from mcp.server import Server
 from mcp.server.sse import SseServerTransport
 from mcp.types import Tool, TextContent
 
-import psycopg2
+from psycopg2 import InterfaceError, OperationalError
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import PoolError, ThreadedConnectionPool
 from starlette.applications import Starlette
 from starlette.routing import Route
 from starlette.responses import Response
@@ -26,23 +28,100 @@ DB_CONFIG = {
     "port": os.getenv("DB_PORT", "5432"),
     "database": os.getenv("DB_NAME", "analytics"),
     "user": os.getenv("DB_USER", "postgres"),
-    "password": os.getenv("DB_PASSWORD", "postgres")
+    "password": os.getenv("DB_PASSWORD", "postgres"),
+    "connect_timeout": int(os.getenv("DB_CONNECT_TIMEOUT", "5")),
+    "application_name": "evodata-mcp-server",
+    # Todas las herramientas son de lectura: PostgreSQL rechaza cualquier escritura en estas conexiones
+    "options": "-c default_transaction_read_only=on"
 }
 
+# Pool de conexiones (mismos nombres que config.py del agente)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+
+# Palabras prohibidas en consultas (mismas que FORBIDDEN_SQL_KEYWORDS en config.py del agente).
+# Una sola pasada regex con límites de palabra: "created_at" o "updated_by" no cuentan como CREATE/UPDATE.
+FORBIDDEN_SQL_KEYWORDS = frozenset({
+    "DROP", "DELETE", "TRUNCATE", "ALTER", "CREATE", "INSERT", "UPDATE",
+    "GRANT", "REVOKE", "EXEC", "EXECUTE", "CALL"
+})
+FORBIDDEN_SQL_PATTERN = re.compile(
+    r"\b(" + "|".join(sorted(map(re.escape, FORBIDDEN_SQL_KEYWORDS), key=len, reverse=True)) + r")\b",
+    re.IGNORECASE
+)
+# Literales '...' e identificadores "..." (con comillas escapadas duplicándolas): se quitan antes de validar,
+# así WHERE status = 'delete' o area = 'Call center' no cuentan como palabras prohibidas
+_SQL_QUOTED_PATTERN = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"")
+
+def validate_select(sql: str) -> Optional[str]:
+    """Mensaje de error si la consulta no es un único SELECT de solo lectura, None si es válida"""
+    code = _SQL_QUOTED_PATTERN.sub("''", sql).strip().rstrip(";").strip()
+    if not code.lower().startswith("select"):
+        return "Solo se permiten consultas SELECT por seguridad."
+    if ";" in code:
+        return "Solo se permite una sentencia por consulta."
+    forbidden = FORBIDDEN_SQL_PATTERN.search(code)
+    if forbidden:
+        return f"Operación no permitida en la consulta ({forbidden.group(1).upper()})."
+    return None
+
 # ==========================================
 # 🔌 MCP SERVER CORE
 # ==========================================
 mcp = Server("evodata-mcp-server")
 sse_transport = SseServerTransport("/messages")
 
+_db_pool: Optional[ThreadedConnectionPool] = None
+
+def get_db_pool() -> ThreadedConnectionPool:
+    """Pool único (lazy): evita handshake TCP + auth de PostgreSQL en cada herramienta"""
+    global _db_pool
+    if _db_pool is None:
+        _db_pool = ThreadedConnectionPool(1, DB_POOL_SIZE + DB_MAX_OVERFLOW, **DB_CONFIG)
+        logger.info(f"🗄️ Pool PostgreSQL creado (max {DB_POOL_SIZE + DB_MAX_OVERFLOW} conexiones)")
+    return _db_pool
+
+def _is_alive(conn) -> bool:
+    """Pre-ping: valida la conexión antes de usarla (PostgreSQL pudo reiniciarse desde el último uso)"""
+    if conn.closed:
+        return False
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        return True
+    except (OperationalError, InterfaceError):
+        return False
+
 def get_db_connection():
-    """Conexión robusta a PostgreSQL"""
+    """
+    Toma una conexión validada del pool (devolver con release_db_connection).
+    Una conexión muerta se descarta y se reintenta una vez con otra.
+    """
+    pool = get_db_pool()
     try:
-        return psycopg2.connect(**DB_CONFIG)
+        for _ in range(2):
+            conn = pool.getconn()
+            if _is_alive(conn):
+                return conn
+            logger.warning("⚠️ Conexión del pool caída, descartando y reintentando")
+            pool.putconn(conn, close=True)
+        raise OperationalError("No se pudo obtener una conexión válida a PostgreSQL")
+    except PoolError as e:
+        # getconn no espera: con el pool agotado falla de inmediato
+        logger.error(f"❌ Pool PostgreSQL agotado ({DB_POOL_SIZE + DB_MAX_OVERFLOW} conexiones): {e}")
+        raise
     except Exception as e:
         logger.error(f"❌ Error DB: {e}")
         raise
 
+def release_db_connection(conn):
+    """Devuelve la conexión al pool; la descarta si quedó rota"""
+    try:
+        conn.rollback()  # Cierra la transacción implícita del SELECT
+        get_db_pool().putconn(conn)
+    except Exception:
+        get_db_pool().putconn(conn, close=True)
+
 @mcp.list_tools()
 async def list_tools() -> list[Tool]:
     """Define las herramientas disponibles para el Agent SDK"""
@@ -88,8 +167,9 @@ async def call_tool(name: str, arguments: Any) -> List[TextContent]:
         
         if name == "query":
             sql = arguments.get("sql", "")
-            if not sql.lower().strip().startswith("select"):
-                return [TextContent(type="text", text="Error: Solo se permiten consultas SELECT por seguridad.")]
+            error = validate_select(sql)
+            if error:
+                return [TextContent(type="text", text=f"Error: {error}")]
             
             cursor.execute(sql)
             results = cursor.fetchall()
@@ -114,7 +194,7 @@ async def call_tool(name: str, arguments: Any) -> List[TextContent]:
         return [TextContent(type="text", text=f"Error en base de datos: {str(e)}")]
     finally:
         if conn:
-            conn.close()
+            release_db_connection(conn)
 
 # ==========================================
 # 🌐 STARLETTE ASGI INTERFACE & ADAPTERS
@@ -157,6 +237,8 @@ async def messages_endpoint(request):
 async def lifespan(app: Starlette):
     logger.info("🚀 Servidor MCP (SSE Mode) iniciado")
     yield
+    if _db_pool is not None:
+        _db_pool.closeall()
     logger.info("🛑 Servidor MCP detenido")
 
 app = Starlette(
@@ -1,6 +1,11 @@
 import sys
+import json
 from pathlib import Path
 
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
 # Add project root to sys.path to allow importing config
 sys.path.append(str(Path(__file__).parent.parent))
 
@@ -11,10 +16,19 @@ headers = {
     "Content-Type": "application/json"
 }
 
+# Sesión compartida: keep-alive entre llamadas (un solo handshake TLS) y reintentos cortos
+session = requests.Session()
+session.headers.update(headers)
+_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=Retry(total=2, backoff_factor=0.2))
+session.mount("https://", _adapter)
+session.mount("http://", _adapter)
+
+REQUEST_TIMEOUT = 10
+
 def check_instance():
     print(f"\n--- Checking Instance Connection: {config.EVOLUTION_INSTANCE} ---")
     try:
-        res = requests.get(f"{config.EVOLUTION_URL}/instance/connectionState/{config.EVOLUTION_INSTANCE}", headers=headers)
+        res = session.get(f"{config.EVOLUTION_URL}/instance/connectionState/{config.EVOLUTION_INSTANCE}", timeout=REQUEST_TIMEOUT)
         print(f"Status: {res.status_code}")
         print(f"Data: {json.dumps(res.json(), indent=2)}")
     except Exception as e:
@@ -23,7 +37,7 @@ def check_instance():
 def check_webhook():
     print(f"\n--- Checking Webhook Config (Instance) ---")
     try:
-        res = requests.get(f"{config.EVOLUTION_URL}/webhook/find/{config.EVOLUTION_INSTANCE}", headers=headers)
+        res = session.get(f"{config.EVOLUTION_URL}/webhook/find/{config.EVOLUTION_INSTANCE}", timeout=REQUEST_TIMEOUT)
         print(f"Status: {res.status_code}")
         if res.status_code == 200:
             print(json.dumps(res.json(), indent=2))
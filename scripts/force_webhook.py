@@ -1,6 +1,11 @@
 import sys
+import json
 from pathlib import Path
 
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
 # Add project root to sys.path to allow importing config
 sys.path.append(str(Path(__file__).parent.parent))
 
@@ -20,6 +25,15 @@ headers = {
     "Content-Type": "application/json"
 }
 
+# Sesión compartida: keep-alive entre llamadas (un solo handshake TLS) y reintentos cortos
+session = requests.Session()
+session.headers.update(headers)
+_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=Retry(total=2, backoff_factor=0.2))
+session.mount("https://", _adapter)
+session.mount("http://", _adapter)
+
+REQUEST_TIMEOUT = 10
+
 def configure_webhook():
     print(f"--- Forzando configuracion del Webhook ---")
     print(f"URL: '{NGROK_URL}'")
@@ -51,7 +65,7 @@ def configure_webhook():
     for payload in [payload_v1, payload_v2]:
         try:
             print(f"\nProbando con payload: {json.dumps(payload)[:100]}...")
-            res = requests.post(f"{config.EVOLUTION_URL}/webhook/set/{config.EVOLUTION_INSTANCE}", headers=headers, json=payload)
+            res = session.post(f"{config.EVOLUTION_URL}/webhook/set/{config.EVOLUTION_INSTANCE}", json=payload, timeout=REQUEST_TIMEOUT)
             print(f"Status: {res.status_code}")
             print(f"Response: {res.text}")
             
@@ -0,0 +1,145 @@
+"""
+🚦 Rate Limiter - Control de tasa para llamadas a APIs externas
+Suaviza ráfagas de envíos hacia EvolutionAPI para no provocar 429.
+"""
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional
+
+
+class AsyncTokenBucket:
+    """
+    Token bucket asíncrono compartido.
+
+    Permite hasta `rate` operaciones por segundo con ráfagas de hasta `capacity`.
+    Las corrutinas que no encuentran token esperan lo justo hasta el siguiente.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        """
+        Args:
+            rate: Tokens repuestos por segundo (> 0)
+            capacity: Tamaño máximo de ráfaga (por defecto igual a `rate`, mínimo 1 token)
+        """
+        self.rate = rate
+        # Con rate < 1 el bucket debe poder llenar al menos un token completo o nunca concede ninguno
+        self.capacity = max(1.0, capacity or rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Consume un token, esperando si el bucket está vacío"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+
+class AimdSlot:
+    """Resultado de una operación dentro de un slot AIMD (lo marca el llamador)"""
+    __slots__ = ("ok",)
+
+    def __init__(self):
+        self.ok = True
+
+
+class AimdLimiter:
+    """
+    Límite de concurrencia adaptativo AIMD (como el control de congestión de TCP).
+
+    - Aumento aditivo: +1 slot por operación exitosa y rápida.
+    - Disminución multiplicativa: límite * `decrease_factor` ante fallo (429/5xx)
+      o latencia por encima de `latency_target`.
+    """
+
+    def __init__(
+        self,
+        initial: int = 8,
+        minimum: int = 1,
+        maximum: int = 64,
+        latency_target: float = 10.0,
+        decrease_factor: float = 0.5
+    ):
+        """
+        Args:
+            initial: Concurrencia inicial
+            minimum: Concurrencia mínima
+            maximum: Concurrencia máxima
+            latency_target: Latencia (segundos) a partir de la cual se reduce el límite
+            decrease_factor: Factor multiplicativo de reducción
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(minimum, min(initial, maximum))
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self._inflight = 0
+        self._waiters: deque = deque()
+
+    async def acquire(self):
+        """Ocupa un slot, esperando si se alcanzó el límite actual"""
+        if self._inflight < self.limit and not self._waiters:
+            self._inflight += 1
+            return
+
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # Si el slot ya se había asignado, devolverlo
+            if fut.done() and not fut.cancelled():
+                self._inflight -= 1
+                self._wake()
+            raise
+
+    def release(self, ok: bool, latency: float):
+        """Libera el slot y ajusta el límite según el resultado"""
+        self._inflight -= 1
+        if not ok or latency > self.latency_target:
+            self.limit = max(self.minimum, int(self.limit * self.decrease_factor))
+        else:
+            self.limit = min(self.maximum, self.limit + 1)
+        self._wake()
+
+    def _wake(self):
+        """Despierta a los que esperan mientras haya slots libres"""
+        while self._waiters and self._inflight < self.limit:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self._inflight += 1
+                fut.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        Context manager: `async with limiter.slot() as slot: ...; slot.ok = False`
+        Las excepciones cuentan como fallo.
+        """
+        await self.acquire()
+        slot = AimdSlot()
+        start = time.monotonic()
+        try:
+            yield slot
+        except BaseException:
+            slot.ok = False
+            raise
+        finally:
+            self.release(slot.ok, time.monotonic() - start)
@@ -0,0 +1,126 @@
+"""
+🧠 Response Cache - Caché de respuestas del agente
+Evita repetir Runner.run (inferencia LLM + consultas MCP) cuando un usuario
+repite la misma pregunta dentro de una ventana corta.
+"""
+import os
+import re
+import time
+import logging
+from collections import OrderedDict
+from typing import Optional, List, Tuple
+import config
+
+logger = logging.getLogger("ResponseCache")
+
+# Plegado de acentos/mayúsculas en una sola pasada C: "Gráfica de Ventas" == "grafica de ventas"
+_ACCENT_TABLE = str.maketrans("áéíóúüÁÉÍÓÚÜñÑ", "aeiouuAEIOUUnN")
+_NON_WORD_PATTERN = re.compile(r"[^\w]+")
+
+# Seguimientos que dependen del turno anterior ("y en marzo?", "pero por cliente"): nunca se cachean
+_FOLLOW_UP_PATTERN = re.compile(r"^(y|e|o|pero|tambien|entonces|igual|ademas|ahora|and|also|what about)\b")
+
+# Preguntas cuya respuesta depende del momento: nunca se cachean
+_TIME_SENSITIVE_PATTERN = re.compile(
+    r"\b(hoy|ahora|ayer|manana|actual\w*|ultim\w*|reciente\w*|today|now|latest)\b"
+)
+
+
+def _normalize(message: str) -> str:
+    """Clave normalizada: minúsculas, sin acentos, sin puntuación ni espacios repetidos"""
+    folded = message.lower().translate(_ACCENT_TABLE)
+    return _NON_WORD_PATTERN.sub(" ", folded).strip()
+
+
+class ResponseCache:
+    """
+    Caché exacta (sobre el mensaje normalizado) por usuario, con TTL y tamaño máximo.
+    Orden de inserción = orden temporal, igual que la deduplicación de webhooks.
+    """
+
+    def __init__(self, ttl: int, max_entries: int, min_words: int = 4):
+        """
+        Args:
+            ttl: Segundos de validez de una respuesta (0 = caché desactivada)
+            max_entries: Máximo de respuestas guardadas
+            min_words: Palabras mínimas para cachear (los mensajes cortos dependen del contexto)
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.min_words = min_words
+        self.enabled = ttl > 0
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, str, List[str]]]" = OrderedDict()
+
+        if self.enabled:
+            logger.info(f"🧠 Caché de respuestas habilitada (TTL: {ttl}s, máx: {max_entries})")
+
+    def _key(self, phone_number: str, message: str) -> Optional[Tuple[str, str]]:
+        """
+        Clave de caché, o None si el mensaje no es cacheable.
+        La clave no incluye el estado de la conversación, así que solo se cachean preguntas
+        autocontenidas: nada de mensajes cortos, seguimientos ni referencias temporales.
+        """
+        normalized = _normalize(message)
+        if len(normalized.split()) < self.min_words:
+            return None
+        if _FOLLOW_UP_PATTERN.match(normalized) or _TIME_SENSITIVE_PATTERN.search(normalized):
+            return None
+        return (phone_number, normalized)
+
+    def _purge(self, now: float):
+        """Elimina entradas expiradas y las más antiguas si se excede el máximo"""
+        while self._entries:
+            stored_at = next(iter(self._entries.values()))[0]
+            if now - stored_at < self.ttl and len(self._entries) < self.max_entries:
+                break
+            self._entries.popitem(last=False)
+
+    def get(self, phone_number: str, message: str) -> Optional[Tuple[str, List[str]]]:
+        """
+        Retorna (respuesta, archivos) si hay una respuesta vigente.
+        Si algún archivo ya no existe (p.ej. STORAGE_SAVE_FILES=false) se trata como fallo de caché.
+        """
+        if not self.enabled:
+            return None
+        key = self._key(phone_number, message)
+        if key is None:
+            return None
+
+        self._purge(time.monotonic())
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        _, response, files = entry
+        if not all(os.path.exists(f) for f in files):
+            del self._entries[key]
+            return None
+        return response, list(files)
+
+    def put(self, phone_number: str, message: str, response: str, files: List[str]):
+        """Guarda la respuesta del agente para el mensaje (si es cacheable)"""
+        if not self.enabled or not response:
+            return
+        key = self._key(phone_number, message)
+        if key is None:
+            return
+
+        now = time.monotonic()
+        self._purge(now)
+        self._entries.pop(key, None)
+        self._entries[key] = (now, response, list(files))
+
+
+# Singleton global
+_cache_instance: Optional[ResponseCache] = None
+
+def get_response_cache() -> ResponseCache:
+    """Factory para obtener la caché de respuestas (singleton)"""
+    global _cache_instance
+    if _cache_instance is None:
+        _cache_instance = ResponseCache(
+            ttl=config.RESPONSE_CACHE_TTL,
+            max_entries=config.RESPONSE_CACHE_MAX_ENTRIES,
+            min_words=config.RESPONSE_CACHE_MIN_WORDS
+        )
+    return _cache_instance
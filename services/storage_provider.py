@@ -5,6 +5,7 @@ Permite cambiar entre local/cloud sin modificar herramientas (SOLID: DIP, OCP)
 from abc import ABC, abstractmethod
 from pathlib import Path
 from typing import Optional
+import os
 import time
 import logging
 
@@ -60,7 +61,8 @@ class LocalStorageProvider(StorageProvider):
         Returns:
             Path absoluto del archivo guardado
         """
-        path = self.base_dir / filename
+        # Solo el nombre: un filename con directorios (p.ej. sugerido por el LLM) no sale de base_dir
+        path = self.base_dir / os.path.basename(filename)
         
         # Evitar sobrescribir archivos existentes
         if path.exists():
@@ -79,7 +81,7 @@ class LocalStorageProvider(StorageProvider):
     
     def get_path(self, filename: str) -> str:
         """Retorna path absoluto del archivo"""
-        return str(self.base_dir / filename)
+        return str(self.base_dir / os.path.basename(filename))
     
     def delete(self, filename: str) -> bool:
         """
@@ -91,8 +93,8 @@ class LocalStorageProvider(StorageProvider):
         Returns:
             True si se eliminó, False si no existía
         """
-        # Soportar tanto filename como path completo
-        if '/' in filename or '\\' in filename:
+        # Soportar tanto filename como path completo (basename en C, sin escanear separadores a mano)
+        if os.path.basename(filename) != filename:
             path = Path(filename)
         else:
             path = self.base_dir / filename
@@ -134,25 +136,34 @@ class LocalStorageProvider(StorageProvider):
         return count
 
 
+_storage_instance: Optional[StorageProvider] = None
+
+
 def get_storage_provider() -> StorageProvider:
     """
-    Factory para obtener el storage provider configurado.
+    Factory para obtener el storage provider configurado (singleton).
+    Visualizer, Excel y webhook comparten la misma instancia.
     
     Pattern: Factory + Strategy
     
     Returns:
         Instancia del storage provider según configuración
     """
+    global _storage_instance
+    if _storage_instance is not None:
+        return _storage_instance
+    
     import config
     
     backend = getattr(config, 'STORAGE_BACKEND', 'local')
     save_files = getattr(config, 'STORAGE_SAVE_FILES', True)
     
     if backend == "local":
-        return LocalStorageProvider(
+        _storage_instance = LocalStorageProvider(
             base_dir=config.EXPORTS_DIR,
             save_files=save_files
         )
+        return _storage_instance
     # Futuro: Agregar S3Provider, AzureProvider
     # elif backend == "s3":
     #     return S3StorageProvider(...)
@@ -23,6 +23,13 @@ class ElevenLabsTTS:
         self.voice_id = getattr(config, 'ELEVENLABS_VOICE_ID', '21m00Tcm4TlvDq8ikWAM')  # Rachel
         self.base_url = "https://api.elevenlabs.io/v1"
         self.enabled = getattr(config, 'ENABLE_VOICE_RESPONSES', False)
+        # Headers fijos: se asignan una vez al cliente compartido
+        self.headers = {
+            "xi-api-key": self.api_key or "",
+            "Content-Type": "application/json"
+        }
+        # Cliente HTTP compartido (lazy): se crea en la primera síntesis
+        self._client: Optional[httpx.AsyncClient] = None
         
         if self.enabled and not self.api_key:
             logger.warning("⚠️ ENABLE_VOICE_RESPONSES=true pero falta ELEVENLABS_API_KEY")
@@ -31,6 +38,12 @@ class ElevenLabsTTS:
         if self.enabled:
             logger.info(f"🎤 ElevenLabs TTS habilitado (Voice: {self.voice_id})")
     
+    def _get_client(self) -> httpx.AsyncClient:
+        """Retorna el cliente HTTP compartido, creándolo en el primer uso"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(timeout=30.0, headers=self.headers)
+        return self._client
+    
     async def text_to_speech(
         self, 
         text: str, 
@@ -58,10 +71,6 @@ class ElevenLabsTTS:
         
         try:
             url = f"{self.base_url}/text-to-speech/{self.voice_id}"
-            headers = {
-                "xi-api-key": self.api_key,
-                "Content-Type": "application/json"
-            }
             
             # Configuración optimizada para español
             payload = {
@@ -77,21 +86,20 @@ class ElevenLabsTTS:
             
             logger.info(f"🎙️ Generando audio ({len(text)} chars)...")
             
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(url, json=payload, headers=headers)
+            response = await self._get_client().post(url, json=payload)
+            
+            if response.status_code == 200:
+                # Guardar audio
+                with open(output_path, 'wb') as f:
+                    f.write(response.content)
                 
-                if response.status_code == 200:
-                    # Guardar audio
-                    with open(output_path, 'wb') as f:
-                        f.write(response.content)
-                    
-                    file_size = len(response.content)
-                    logger.info(f"✅ Audio generado: {output_path} ({file_size} bytes)")
-                    return True
-                else:
-                    error_msg = response.text
-                    logger.error(f"❌ Error ElevenLabs ({response.status_code}): {error_msg}")
-                    return False
+                file_size = len(response.content)
+                logger.info(f"✅ Audio generado: {output_path} ({file_size} bytes)")
+                return True
+            else:
+                error_msg = response.text
+                logger.error(f"❌ Error ElevenLabs ({response.status_code}): {error_msg}")
+                return False
         
         except httpx.TimeoutException:
             logger.error("⏱️ Timeout generando audio (>30s)")
@@ -125,6 +133,12 @@ class ElevenLabsTTS:
             return False
         
         return True
+    
+    async def close(self):
+        """Cierra el cliente HTTP compartido (si se llegó a crear)"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
 
 
 # Singleton global
@@ -2,67 +2,275 @@
 📞 WhatsApp Service - EvolutionAPI Integration
 Maneja el envío de mensajes y archivos a través de EvolutionAPI de forma asíncrona.
 """
+import asyncio
 import base64
-import mimetypes
+import functools
+import random
+import re
+import socket
 import httpx
+import orjson
+from dataclasses import dataclass
 from typing import Dict, Any, Optional, List
 from pathlib import Path
+from urllib.parse import quote
 
 import config
+from services.rate_limiter import AimdLimiter, AsyncTokenBucket
 from utils.logger import get_logger
 
 logger = get_logger("WhatsAppService")
 
+# Respuestas transitorias de EvolutionAPI que vale la pena reintentar
+_RETRY_STATUSES = frozenset({429, 502, 503, 504})
+
+# Respuestas que indican que la instancia no acepta sendMedia como multipart (se desactiva para el proceso)
+_MULTIPART_UNSUPPORTED_STATUSES = frozenset({404, 415})
+# 400/422 también llegan por problemas del mensaje (número, caption): solo cuentan si el cuerpo
+# habla del formato de subida, y entonces se usa base64 únicamente para ese envío
+_MULTIPART_REJECTED_STATUSES = frozenset({400, 422})
+_MULTIPART_REJECTED_PATTERN = re.compile(r"multipart|form-data|unsupported|not supported|media .*required|file .*required", re.IGNORECASE)
+
+# Content-Type por request: el cliente no lo fija para poder enviar también multipart
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+def _retry_delay(res: httpx.Response, attempt: int) -> float:
+    """
+    Espera antes del siguiente intento: Retry-After si viene, si no backoff exponencial con jitter.
+    Retry-After se acota al backoff máximo: un valor enorme no puede congelar la respuesta al usuario.
+    """
+    retry_after = res.headers.get("Retry-After")
+    if retry_after:
+        try:
+            max_delay = config.EVOLUTION_RETRY_BACKOFF * (2 ** config.EVOLUTION_MAX_RETRIES)
+            return min(max(0.0, float(retry_after)), max_delay)
+        except ValueError:
+            pass  # Formato fecha HTTP: usar backoff
+    delay = config.EVOLUTION_RETRY_BACKOFF * (2 ** attempt)
+    return delay + random.uniform(0, delay / 2)
+
+# Tamaño de lectura para base64 incremental (múltiplo de 3: sin padding intermedio)
+_B64_CHUNK_SIZE = 57 * 1024
+
+def _encode_file_base64(path: Path) -> str:
+    """
+    Codifica un archivo en base64 leyendo por bloques.
+    Evita mantener en memoria los bytes crudos completos junto al string codificado.
+    """
+    buf = bytearray()
+    with open(path, "rb") as f:
+        while chunk := f.read(_B64_CHUNK_SIZE):
+            buf += base64.b64encode(chunk)
+    return buf.decode("ascii")
+
+@functools.lru_cache(maxsize=32)
+def _instance_url(base_url: str, path: str, instance: str) -> str:
+    """
+    Endpoint por instancia: elimina invisibles y URL-encodea el nombre una sola vez.
+    Instancias con espacios o '/' ya no rompen la ruta.
+    """
+    instance = "".join(ch for ch in instance.strip() if ch.isprintable())
+    return f"{base_url}/{path}/{quote(instance, safe='')}"
+
+@functools.lru_cache(maxsize=4096)
+def _normalize_phone_number(number: str) -> str:
+    """Formato @c.us, memoizado: los mismos remitentes escriben una y otra vez"""
+    if "@" not in number:
+        return f"{number}@c.us"
+    return number.replace("@s.whatsapp.net", "@c.us")
+
+async def _wait_done(task: Optional[asyncio.Task]):
+    """Espera a que la tarea termine (éxito o error) sin propagar su excepción"""
+    if task is not None:
+        await asyncio.wait((task,))
+
+@dataclass(slots=True)
+class SendResult:
+    """Resultado de un envío a EvolutionAPI (reemplaza los checks de status dispersos)"""
+    ok: bool
+    status_code: Optional[int] = None
+    error: Optional[str] = None
+
 class WhatsAppService:
     """Servicio asíncrono para interactuar con EvolutionAPI"""
     
     def __init__(self):
-        self.base_url = config.EVOLUTION_URL
+        self.base_url = config.EVOLUTION_URL.rstrip("/")
         self.instance = config.EVOLUTION_INSTANCE
-        self.api_key = config.EVOLUTION_API_KEY
+        self.api_key = config.EVOLUTION_API_KEY or ""
+        if not self.api_key:
+            logger.warning("⚠️ EVOLUTION_API_KEY no configurado: los envíos serán rechazados")
+        # Endpoints precalculados una vez (sin '//' cuando EVOLUTION_URL termina en '/')
+        self.send_text_url = _instance_url(self.base_url, "message/sendText", self.instance)
+        self.send_media_url = _instance_url(self.base_url, "message/sendMedia", self.instance)
         self.headers = {
-            "apikey": self.api_key,
-            "Content-Type": "application/json"
+            "apikey": self.api_key
         }
-        # Client reusable para eficiencia (SOLID: Performance)
-        self.client = httpx.AsyncClient(headers=self.headers, timeout=60.0)
+        # Client reusable con pool keep-alive: evita un handshake TCP+TLS por envío
+        # Timeouts explícitos: un backend colgado no bloquea el flujo indefinidamente.
+        # TCP_NODELAY: los JSON pequeños (sendText) salen sin esperar a Nagle.
+        # HTTP/2 (opcional): texto y adjuntos multiplexados sobre una sola conexión TLS.
+        limits = httpx.Limits(
+            max_connections=config.EVOLUTION_MAX_CONNECTIONS,
+            max_keepalive_connections=config.EVOLUTION_MAX_KEEPALIVE
+        )
+        self.client = httpx.AsyncClient(
+            headers=self.headers,
+            timeout=httpx.Timeout(config.EVOLUTION_READ_TIMEOUT, connect=config.EVOLUTION_CONNECT_TIMEOUT),
+            limits=limits,
+            transport=httpx.AsyncHTTPTransport(
+                retries=config.EVOLUTION_CONNECT_RETRIES,
+                limits=limits,
+                http2=config.EVOLUTION_HTTP2,
+                socket_options=[(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)]
+            )
+        )
+        # Token bucket compartido por todos los envíos de esta instancia
+        self.rate_limiter = AsyncTokenBucket(config.EVOLUTION_MAX_RPS) if config.EVOLUTION_MAX_RPS > 0 else None
+        # Concurrencia adaptativa: crece con respuestas rápidas, se reduce ante 429/5xx
+        self.concurrency = AimdLimiter(
+            maximum=config.EVOLUTION_MAX_CONCURRENCY,
+            latency_target=config.EVOLUTION_LATENCY_TARGET
+        )
+        # Multipart para adjuntos (se desactiva solo si la instancia lo rechaza)
+        self.multipart_media = config.EVOLUTION_MULTIPART_MEDIA
+        # Cola de envíos en segundo plano (se crea con el primer enqueue, dentro del event loop)
+        self._send_queue: Optional[asyncio.Queue] = None
+        self._send_workers: List[asyncio.Task] = []
     
-    async def send_text_message(self, phone_number: str, message: str) -> bool:
-        """Envía mensaje de texto simple de forma asíncrona"""
-        try:
-            url = f"{self.base_url}/message/sendText/{self.instance}"
-            payload = {
-                "number": phone_number,
-                "text": message,
-                "delay": 1000,
-                "linkPreview": False
-            }
+    async def _post_json(self, url: str, payload: Dict[str, Any], **kwargs) -> httpx.Response:
+        """
+        POST con el payload serializado por orjson (C) en vez de json stdlib.
+        Relevante para sendMedia, cuyo campo 'media' es un string base64 de varios MB.
+        """
+        return await self._post(url, content=orjson.dumps(payload), headers=_JSON_HEADERS, **kwargs)
+    
+    async def _post(self, url: str, **kwargs) -> httpx.Response:
+        """
+        POST con rate limiting y concurrencia adaptativa (JSON o multipart según kwargs).
+        
+        Reintenta 429/502/503/504 hasta EVOLUTION_MAX_RETRIES veces respetando Retry-After,
+        para no perder notificaciones por fallos transitorios o rate limiting.
+        """
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                await self.rate_limiter.acquire()
+            async with self.concurrency.slot() as slot:
+                res = await self.client.post(url, **kwargs)
+                slot.ok = res.status_code not in _RETRY_STATUSES
+            if res.status_code not in _RETRY_STATUSES or attempt >= config.EVOLUTION_MAX_RETRIES:
+                return res
             
-            res = await self.client.post(url, json=payload)
-            return res.status_code in (200, 201)
+            delay = _retry_delay(res, attempt)
+            attempt += 1
+            logger.warning("⏳ EvolutionAPI respondió %s, reintento %d en %.1fs", res.status_code, attempt, delay)
+            await asyncio.sleep(delay)
+    
+    async def _send(self, url: str, payload: Optional[Dict[str, Any]] = None, **kwargs) -> SendResult:
+        """
+        Envía el payload JSON (o el multipart de kwargs si no hay payload) y normaliza
+        el resultado (errores de red incluidos) en un SendResult.
+        """
+        try:
+            if payload is not None:
+                res = await self._post_json(url, payload)
+            else:
+                res = await self._post(url, **kwargs)
         except Exception as e:
-            logger.error(f"❌ Error enviando texto: {str(e)}")
+            return SendResult(False, error=str(e))
+        
+        if res.status_code in (200, 201):
+            return SendResult(True, res.status_code)
+        return SendResult(False, res.status_code, res.text[:200])
+    
+    def _ensure_send_workers(self):
+        """Crea la cola y arranca los workers en el event loop actual (una sola vez)"""
+        if self._send_queue is not None:
+            return
+        self._send_queue = asyncio.Queue(maxsize=config.EVOLUTION_SEND_QUEUE_SIZE)
+        loop = asyncio.get_running_loop()
+        self._send_workers = [
+            loop.create_task(self._send_worker(), name=f"evolution-sender-{i}")
+            for i in range(max(1, config.EVOLUTION_SEND_WORKERS))
+        ]
+        logger.info("📬 Cola de envíos iniciada (%d workers)", len(self._send_workers))
+    
+    async def _send_worker(self):
+        """Consume la cola de envíos; comparte pool, rate limiter y reintentos con el resto"""
+        while True:
+            phone_number, message = await self._send_queue.get()
+            try:
+                await self.send_text_message(phone_number, message)
+            except Exception as e:
+                logger.error("❌ Error en worker de envíos: %s", e)
+            finally:
+                self._send_queue.task_done()
+    
+    def enqueue_text_message(self, phone_number: str, message: str) -> bool:
+        """
+        Encola un texto para envío en segundo plano y retorna de inmediato.
+        Debe llamarse desde el event loop. Retorna False si la cola está llena.
+        """
+        self._ensure_send_workers()
+        try:
+            self._send_queue.put_nowait((phone_number, message))
+            return True
+        except asyncio.QueueFull:
+            logger.error("❌ Cola de envíos llena, mensaje descartado para %s", phone_number)
             return False
+    
+    async def send_text_message(self, phone_number: str, message: str) -> bool:
+        """Envía mensaje de texto simple de forma asíncrona"""
+        payload = {
+            "number": phone_number,
+            "text": message,
+            "delay": 1000,
+            "linkPreview": False
+        }
+        
+        result = await self._send(self.send_text_url, payload)
+        if not result.ok:
+            logger.error("❌ Error enviando texto (%s): %s", result.status_code, result.error)
+        return result.ok
 
-    async def send_attachment(self, phone_number: str, file_path: str, caption: str = "") -> bool:
-        """Lee un archivo local y lo envía de forma asíncrona"""
+    async def send_attachment(
+        self, phone_number: str, file_path: str, caption: str = "", after: Optional[asyncio.Task] = None
+    ) -> bool:
+        """
+        Lee un archivo local y lo envía de forma asíncrona.
+        
+        Args:
+            after: Tarea que debe terminar antes del POST (p.ej. el texto de la respuesta);
+                   la lectura/codificación del archivo se solapa con ella.
+        """
         try:
             path = Path(file_path)
-            if not path.exists():
-                logger.error(f"❌ Archivo no encontrado: {file_path}")
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                logger.error("❌ Archivo no encontrado: %s", file_path)
                 return False
-                
-            # Leer archivo de forma bloqueante (pequeños archivos de exportación)
-            # Para archivos grandes se podría usar aiofiles, pero para charts/excel < 1MB está bien.
-            with open(path, "rb") as f:
-                data_b64 = base64.b64encode(f.read()).decode('utf-8')
             
+            # Descartar antes de leer/codificar lo que WhatsApp rechazaría de todos modos
+            if st.st_size > config.MAX_FILE_SIZE_MB * 1024 * 1024:
+                logger.error("❌ Adjunto excede %s MB: %s", config.MAX_FILE_SIZE_MB, file_path)
+                return False
+                
             filename = path.name
-            mimetype, _ = mimetypes.guess_type(file_path)
-            mimetype = mimetype or "application/octet-stream"
+            mimetype = config.EXPORT_MIME_TYPES.get(path.suffix.lower(), "application/octet-stream")
             mediatype = "image" if mimetype.startswith("image/") else "document"
             
-            url = f"{self.base_url}/message/sendMedia/{self.instance}"
+            if self.multipart_media:
+                result = await self._send_media_multipart(phone_number, path, filename, mimetype, mediatype, caption, after)
+                if result is not None:
+                    if not result.ok:
+                        logger.error("❌ Error enviando adjunto %s (%s): %s", file_path, result.status_code, result.error)
+                    return result.ok
+            
+            # Lectura + base64 en un hilo: no bloquear el event loop con adjuntos de varios MB
+            data_b64 = await asyncio.to_thread(_encode_file_base64, path)
+            
             payload = {
                 "number": phone_number,
                 "mediatype": mediatype,
@@ -72,12 +280,45 @@ class WhatsAppService:
                 "caption": caption
             }
             
-            res = await self.client.post(url, json=payload)
-            return res.status_code in (200, 201)
+            await _wait_done(after)
+            result = await self._send(self.send_media_url, payload)
+            if not result.ok:
+                logger.error("❌ Error enviando adjunto %s (%s): %s", file_path, result.status_code, result.error)
+            return result.ok
         except Exception as e:
-            logger.error(f"❌ Error enviando adjunto {file_path}: {str(e)}")
+            logger.error("❌ Error enviando adjunto %s: %s", file_path, e)
             return False
 
+    async def _send_media_multipart(
+        self, phone_number: str, path: Path, filename: str, mimetype: str, mediatype: str, caption: str,
+        after: Optional[asyncio.Task] = None
+    ) -> Optional[SendResult]:
+        """
+        Envía el adjunto como multipart con los bytes crudos (~25% menos bytes, sin base64).
+        Retorna None si la instancia rechazó el formato multipart: el llamador reenvía en base64.
+        Solo 404/415 desactivan multipart para el resto del proceso.
+        """
+        data = await asyncio.to_thread(path.read_bytes)
+        fields = {
+            "number": phone_number,
+            "mediatype": mediatype,
+            "mimetype": mimetype,
+            "fileName": filename,
+            "caption": caption
+        }
+        await _wait_done(after)
+        result = await self._send(self.send_media_url, data=fields, files={"file": (filename, data, mimetype)})
+        if result.ok:
+            return result
+        if result.status_code in _MULTIPART_UNSUPPORTED_STATUSES:
+            logger.warning("⚠️ sendMedia multipart no soportado (%s), usando base64", result.status_code)
+            self.multipart_media = False
+            return None
+        if result.status_code in _MULTIPART_REJECTED_STATUSES and _MULTIPART_REJECTED_PATTERN.search(result.error or ""):
+            logger.warning("⚠️ sendMedia rechazó el multipart (%s), reenviando %s en base64", result.status_code, filename)
+            return None
+        return result
+
     async def send_voice_note(self, phone_number: str, audio_path: str) -> bool:
         """
         Envía nota de voz (audio/mp3) de forma asíncrona.
@@ -92,14 +333,11 @@ class WhatsAppService:
         try:
             path = Path(audio_path)
             if not path.exists():
-                logger.error(f"❌ Audio no encontrado: {audio_path}")
+                logger.error("❌ Audio no encontrado: %s", audio_path)
                 return False
             
-            # Leer archivo de audio
-            with open(path, "rb") as f:
-                data_b64 = base64.b64encode(f.read()).decode('utf-8')
+            data_b64 = await asyncio.to_thread(_encode_file_base64, path)
             
-            url = f"{self.base_url}/message/sendMedia/{self.instance}"
             payload = {
                 "number": phone_number,
                 "mediatype": "audio",
@@ -108,15 +346,14 @@ class WhatsAppService:
                 "fileName": "respuesta_voz.mp3"
             }
             
-            res = await self.client.post(url, json=payload)
-            if res.status_code in (200, 201):
-                logger.info(f"🎤 Nota de voz enviada a {phone_number}")
-                return True
+            result = await self._send(self.send_media_url, payload)
+            if result.ok:
+                logger.info("🎤 Nota de voz enviada a %s", phone_number)
             else:
-                logger.error(f"❌ Error enviando voz ({res.status_code}): {res.text}")
-                return False
+                logger.error("❌ Error enviando voz (%s): %s", result.status_code, result.error)
+            return result.ok
         except Exception as e:
-            logger.error(f"❌ Error enviando voz a {phone_number}: {str(e)}")
+            logger.error("❌ Error enviando voz a %s: %s", phone_number, e)
             return False
 
     async def send_message_with_response(self, phone_number: str, response_data: Dict[str, Any]) -> bool:
@@ -124,34 +361,55 @@ class WhatsAppService:
         Envía la respuesta del agente (texto + archivos) de forma asíncrona.
         """
         try:
-            # 1. Enviar texto principal
             text = response_data.get("response", "")
-            if text:
-                await self.send_text_message(phone_number, text)
-            
-            # 2. Enviar archivos (si hay)
             files = response_data.get("files", [])
-            for file_path in files:
-                await self.send_attachment(phone_number, file_path)
-                
+            # 1. Texto principal + enlaces de descarga (url/both) en una tarea propia,
+            # para que los adjuntos se preparen mientras el texto está en vuelo
+            text_task = asyncio.create_task(
+                self._send_response_texts(phone_number, text, files if config.FILE_DELIVERY_LINKS else None)
+            )
+            
+            # 2. Enviar archivos (attachment/both) en paralelo: ~una latencia en vez de N
+            # (el pool de conexiones, el token bucket y el límite AIMD acotan la ráfaga).
+            # Cada POST espera al texto para conservar el orden en el chat.
+            if files and config.FILE_DELIVERY_ATTACHMENTS:
+                results = await asyncio.gather(
+                    *(self.send_attachment(phone_number, file_path, after=text_task) for file_path in files),
+                    return_exceptions=True
+                )
+                for file_path, sent in zip(files, results):
+                    if sent is not True:
+                        logger.warning("⚠️ Adjunto no enviado: %s (%s)", file_path, sent)
+            
+            await text_task
             return True
         except Exception as e:
-            logger.error(f"❌ Error en send_message_with_response: {str(e)}")
+            logger.error("❌ Error en send_message_with_response: %s", e)
             return False
 
+    async def _send_response_texts(self, phone_number: str, text: str, link_files: Optional[List[str]]):
+        """Envía el texto de la respuesta y, si aplica, el mensaje con enlaces de descarga"""
+        if text:
+            await self.send_text_message(phone_number, text)
+        if link_files:
+            await self.send_text_message(phone_number, self._format_file_links(link_files))
+
+    def _format_file_links(self, files: List[str]) -> str:
+        """Mensaje con los enlaces del file server para cada archivo generado"""
+        base = config.FILE_SERVER_URL.rstrip("/")
+        links = "\n".join(f"• {base}/{quote(Path(f).name)}" for f in files)
+        return f"📎 Archivos generados:\n{links}"
+
     def normalize_phone_number(self, number: str) -> str:
         """Asegura formato @c.us"""
-        if "@" not in number:
-            return f"{number}@c.us"
-        return number.replace("@s.whatsapp.net", "@c.us")
+        return _normalize_phone_number(number)
 
     async def fetch_media(self, message_key: Dict[str, Any], instance_name: Optional[str] = None, message_data: Optional[Dict[str, Any]] = None) -> Optional[str]:
         """Obtiene base64 de un mensaje de media de Evolution (con fallback y robustez)."""
         instance = (instance_name or self.instance or "").strip()
         try:
-            # 1. Normalizar instance (eliminar invisibles)
-            instance = "".join(ch for ch in instance if ch.isprintable())
-            url = f"{self.base_url.rstrip('/')}/chat/getBase64FromMediaMessage/{instance}"
+            # 1. Normalizar instance (eliminar invisibles, URL-encode; cacheado por instancia)
+            url = _instance_url(self.base_url, "chat/getBase64FromMediaMessage", instance)
             
             # 2. Reconstruir KEY completa
             key = message_key.copy() if message_key else {}
@@ -173,34 +431,36 @@ class WhatsAppService:
             # Filtrar vacíos y duplicados
             payloads = [p for p in payloads if p]
 
-            logger.info(f"💾 Recuperando media para {instance} | ID: {key.get('id')}")
+            logger.info("💾 Recuperando media para %s | ID: %s", instance, key.get('id'))
             
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                for idx, payload in enumerate(payloads):
-                    try:
-                        logger.debug(f"➡️ Intento {idx+1} con payload: {list(payload.keys())}")
-                        res = await client.post(
-                            url, 
-                            json=payload, 
-                            headers={"apikey": self.api_key, "Content-Type": "application/json"}
-                        )
-                        
-                        if res.status_code in (200, 201):
-                            data = res.json()
-                            base64_data = data.get("base64") or data.get("data")
-                            if base64_data:
-                                logger.info(f"✅ Media obtenida con éxito (Intento {idx+1})")
-                                return base64_data
-                        
-                        logger.warning(f"⚠️ Intento {idx+1} falló ({res.status_code}): {res.text[:100]}")
-                    except Exception as e:
-                        logger.error(f"❌ Error en intento {idx+1}: {e}")
+            # Reutiliza el pool del cliente compartido (sin handshake nuevo por media)
+            for idx, payload in enumerate(payloads):
+                try:
+                    logger.debug("➡️ Intento %d con payload: %s", idx + 1, payload.keys())
+                    res = await self._post_json(url, payload, timeout=30.0)
+                    
+                    if res.status_code in (200, 201):
+                        data = orjson.loads(res.content)
+                        base64_data = data.get("base64") or data.get("data")
+                        if base64_data:
+                            logger.info("✅ Media obtenida con éxito (Intento %d)", idx + 1)
+                            return base64_data
+                    
+                    logger.warning("⚠️ Intento %d falló (%s): %.100s", idx + 1, res.status_code, res.text)
+                except Exception as e:
+                    logger.error("❌ Error en intento %d: %s", idx + 1, e)
 
             return None
         except Exception as e:
-            logger.error(f"❌ Excepción crítica en fetch_media: {str(e)}")
+            logger.error("❌ Excepción crítica en fetch_media: %s", e)
             return None
     
     async def close(self):
-        """Cierra el cliente HTTP"""
+        """Detiene los workers de la cola y cierra el cliente HTTP"""
+        for task in self._send_workers:
+            task.cancel()
+        if self._send_workers:
+            await asyncio.gather(*self._send_workers, return_exceptions=True)
+        self._send_workers = []
+        self._send_queue = None
         await self.client.aclose()
@@ -6,6 +6,7 @@ import math
 import ast
 import operator
 import logging
+from functools import lru_cache
 
 from agents import function_tool
 
@@ -36,6 +37,15 @@ class MathEvaluator:
             return self.FUNCTIONS[node.func.id](*[self.eval_node(arg) for arg in node.args])
         raise ValueError(f"Operación no permitida: {type(node).__name__}")
 
+# Instancia única: el evaluador no guarda estado entre llamadas
+_EVALUATOR = MathEvaluator()
+
+@lru_cache(maxsize=512)
+def _evaluate(expression: str) -> float:
+    """Parsea y evalúa la expresión; las repetidas se sirven desde caché (los errores no se cachean)"""
+    node = ast.parse(expression, mode='eval')
+    return float(_EVALUATOR.eval_node(node.body))
+
 @function_tool
 def calculate_expression(expression: str) -> float:
     """
@@ -46,10 +56,7 @@ def calculate_expression(expression: str) -> float:
         expression: La expresión matemática a evaluar (ej: "sqrt(25) + 10").
     """
     try:
-        evaluator = MathEvaluator()
-        node = ast.parse(expression, mode='eval')
-        result = evaluator.eval_node(node.body)
-        return float(result)
+        return _evaluate(expression.strip())
     except Exception as e:
         logger.error(f"❌ Error en calculadora: {str(e)}")
         raise ValueError(f"Error evaluando la expresión: {str(e)}")
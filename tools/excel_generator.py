@@ -2,17 +2,20 @@
 📁 Excel Generator Tool - Integración con OpenAI Agents SDK
 Generador de reportes profesionales en Excel con Pydantic.
 """
-import pandas as pd
 import json
+import orjson
 import logging
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import Optional, TYPE_CHECKING
 from pydantic import BaseModel, Field
 
 from agents import function_tool
 import config
 
+if TYPE_CHECKING:
+    import pandas as pd
+
 logger = logging.getLogger("ExcelTool")
 
 class ExcelResult(BaseModel):
@@ -28,7 +31,7 @@ class ExcelManager:
         from services.storage_provider import get_storage_provider
         self.storage = get_storage_provider()
 
-    def generate(self, data: pd.DataFrame, filename: str) -> str:
+    def generate(self, data: "pd.DataFrame", filename: str) -> str:
         """
         Genera archivo Excel usando Storage Provider.
         
@@ -40,6 +43,8 @@ class ExcelManager:
             Path del archivo generado
         """
         from io import BytesIO
+        import pandas as pd
+        from openpyxl.utils import get_column_letter
         
         if not filename.endswith(".xlsx"):
             filename += ".xlsx"
@@ -49,13 +54,11 @@ class ExcelManager:
         with pd.ExcelWriter(buf, engine='openpyxl') as writer:
             data.to_excel(writer, index=False, sheet_name="Reporte")
             
-            # Ajustar anchos de columnas
-            workbook = writer.book
+            # Ajustar anchos de columnas (longitudes vectorizadas con .str.len, sin lambda por celda)
             worksheet = writer.sheets["Reporte"]
-            for idx, col in enumerate(data.columns):
-                max_len = max(data[col].astype(str).map(len).max(), len(col)) + 2
-                col_letter = chr(65 + idx) if idx < 26 else f"A{chr(65 + idx - 26)}"
-                worksheet.column_dimensions[col_letter].width = min(max_len, 50)
+            for idx, col in enumerate(data.columns, start=1):
+                max_len = max(data[col].astype(str).str.len().max(), len(str(col))) + 2
+                worksheet.column_dimensions[get_column_letter(idx)].width = min(max_len, 50)
 
         buf.seek(0)
         excel_data = buf.read()
@@ -77,19 +80,27 @@ def generate_excel_report(data_json: str, filename: str) -> ExcelResult:
         filename: Nombre sugerido para el archivo (ej: 'ventas_reporte.xlsx').
     """
     try:
-        data = json.loads(data_json)
+        import pandas as pd
+
+        try:
+            data = orjson.loads(data_json)
+        except orjson.JSONDecodeError:
+            # orjson rechaza NaN/Infinity, que el servidor MCP emite (json.dumps) para valores nulos numéricos
+            data = json.loads(data_json)
         df = pd.DataFrame(data)
         
         if df.empty:
             return ExcelResult(success=False, message="No hay datos para generar el Excel.", filename=filename)
 
         path = excel_manager.generate(df, filename)
+        # Nombre real en disco (el storage puede agregar .xlsx o un sufijo _N)
+        saved_name = Path(path).name
         
         return ExcelResult(
             success=True,
-            message=f"Archivo Excel '{filename}' generado correctamente.",
+            message=f"Archivo Excel '{saved_name}' generado correctamente.",
             file_path=path,
-            filename=filename
+            filename=saved_name
         )
 
     except Exception as e:
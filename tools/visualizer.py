@@ -3,26 +3,34 @@
 Generador de visualizaciones profesionales usando matplotlib y seaborn.
 Retorna resultados estructurados con Pydantic.
 """
-import pandas as pd
 import json
+import orjson
 import logging
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional
 from pydantic import BaseModel, Field
 
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import seaborn as sns
-
 from agents import function_tool
 import config
 
 logger = logging.getLogger("VisualizerTool")
 
-# Configuración de estilo
-plt.style.use('seaborn-v0_8-darkgrid')
+@lru_cache(maxsize=None)
+def _plotting():
+    """
+    Importa matplotlib/seaborn en el primer gráfico (no al arrancar el webhook).
+    Retorna (plt, sns) con backend Agg y el estilo ya configurados.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    # Configuración de estilo
+    plt.style.use('seaborn-v0_8-darkgrid')
+    return plt, sns
 
 class ChartResult(BaseModel):
     """Resultado estructurado de la generación de un gráfico"""
@@ -58,6 +66,7 @@ class VisualizerManager:
         fig.savefig(buf, format='png', dpi=config.PLOT_DPI, bbox_inches='tight')
         buf.seek(0)
         data = buf.read()
+        plt, _ = _plotting()
         plt.close(fig)
         
         # Usar storage provider para guardar
@@ -67,6 +76,28 @@ class VisualizerManager:
 
 viz_manager = VisualizerManager()
 
+def _plot_frame(data, x_axis: Optional[str], y_axis: Optional[str]):
+    """
+    DataFrame solo con las columnas que se grafican, junto con los ejes resueltos
+    (explícitos o, si faltan, las dos primeras columnas de los datos).
+    Con registros anchos evita inferir tipos de columnas que nunca se usan.
+    Cualquier otra forma de datos (o ejes inexistentes) usa el DataFrame completo.
+    """
+    import pandas as pd
+
+    if isinstance(data, list) and data and isinstance(data[0], dict):
+        columns = list(data[0])
+        x = x_axis or (columns[0] if columns else None)
+        y = y_axis or (columns[1] if len(columns) > 1 else None)
+        plotted = [c for c in dict.fromkeys((x, y)) if c is not None]
+        if plotted and all(c in data[0] for c in plotted):
+            return pd.DataFrame({c: [row.get(c) for row in data] for c in plotted}), x, y
+
+    df = pd.DataFrame(data)
+    x = x_axis or (df.columns[0] if len(df.columns) else None)
+    y = y_axis or (df.columns[1] if len(df.columns) > 1 else None)
+    return df, x, y
+
 @function_tool
 def generate_chart(
     data_json: str, 
@@ -86,16 +117,19 @@ def generate_chart(
         y_axis: Nombre de la columna para el eje Y.
     """
     try:
-        data = json.loads(data_json)
-        df = pd.DataFrame(data)
+        plt, sns = _plotting()
+
+        try:
+            data = orjson.loads(data_json)
+        except orjson.JSONDecodeError:
+            # orjson rechaza NaN/Infinity, que el servidor MCP emite (json.dumps) para valores nulos numéricos
+            data = json.loads(data_json)
+        # Auto-selección de ejes si no se proveen (primeras dos columnas de los datos)
+        df, x_axis, y_axis = _plot_frame(data, x_axis, y_axis)
         
         if df.empty:
             return ChartResult(success=False, message="No hay datos para graficar.", chart_type=chart_type)
 
-        # Auto-selección de ejes si no se proveen
-        if not x_axis: x_axis = df.columns[0]
-        if not y_axis and len(df.columns) > 1: y_axis = df.columns[1]
-
         fig, ax = plt.subplots(figsize=(10, 6))
         
         if chart_type == "bar":
@@ -2,27 +2,50 @@
 🎤 Whisper Utility
 Utilidad ligera para transcripción de audio usando OpenAI Whisper.
 """
+import os
+from functools import lru_cache
 from openai import AsyncOpenAI
 import config
 from utils.logger import get_logger
 
 logger = get_logger("WhisperUtil")
 
+# MIME por extensión para el multipart de Whisper
+_AUDIO_MIME_BY_EXT = {
+    ".ogg": "audio/ogg",
+    ".mp3": "audio/mpeg",
+    ".wav": "audio/wav",
+    ".m4a": "audio/mp4",
+    ".webm": "audio/webm",
+}
+
+@lru_cache(maxsize=1)
+def _get_client() -> AsyncOpenAI:
+    """Cliente OpenAI compartido, creado en la primera transcripción (reutiliza su pool TLS)"""
+    return AsyncOpenAI(api_key=config.OPENAI_API_KEY)
+
 async def transcribe_audio(audio_path: str) -> str:
     """
     Transcribe un archivo de audio de forma asíncrona.
     """
-    client = AsyncOpenAI(api_key=config.OPENAI_API_KEY)
+    client = _get_client()
     try:
-        import os
         if not os.path.exists(audio_path):
             raise FileNotFoundError(f"Audio no encontrado: {audio_path}")
-            
-        logger.info(f"🎤 Transcribiendo {audio_path}...")
+
+        # Rechazar antes de leer/subir archivos que Whisper no aceptará
+        size_mb = os.path.getsize(audio_path) / (1024 * 1024)
+        if size_mb > config.MAX_FILE_SIZE_MB:
+            raise ValueError(f"Audio demasiado grande ({size_mb:.1f} MB > {config.MAX_FILE_SIZE_MB} MB)")
+
+        logger.info("🎤 Transcribiendo %s...", audio_path)
+        file_name = os.path.basename(audio_path)
+        mime_type = _AUDIO_MIME_BY_EXT.get(os.path.splitext(file_name)[1].lower(), "application/octet-stream")
         with open(audio_path, "rb") as f:
+            # Tupla (nombre, archivo, mime): el SDK arma el multipart desde el handle abierto
             transcript = await client.audio.transcriptions.create(
                 model=config.WHISPER_MODEL,
-                file=f,
+                file=(file_name, f, mime_type),
                 language=config.WHISPER_LANGUAGE
             )
         return transcript.text
@@ -2,10 +2,15 @@
 🔗 Webhook Server for EvoDataAgent (FastAPI)
 Recibe mensajes de EvolutionAPI y los procesa con el Agente Nativo (SDK).
 """
-import json
+import asyncio
+import base64
+import orjson
+import time
 import uuid
 import logging
 import httpx
+from collections import OrderedDict
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional, Dict, Any
 
@@ -13,9 +18,10 @@ from fastapi import FastAPI, Depends, BackgroundTasks, Request
 from fastapi.middleware.cors import CORSMiddleware
 
 import config
-from evodata_agent import EvoDataAgent
+from evodata_agent import EvoDataAgent, discard_voice_task
 from services.whatsapp_service import WhatsAppService
-from utils.logger import get_logger
+from services.storage_provider import get_storage_provider
+from utils.logger import get_logger, log_error_with_context
 
 logger = get_logger("WebhookServer")
 
@@ -24,18 +30,19 @@ app = FastAPI(title=f"{config.AGENT_NAME} API", version=config.AGENT_VERSION)
 @app.on_event("startup")
 async def startup_event():
     """Inicialización al arrancar el servidor"""
-    import os
-    for directory in [config.TEMP_DIR, config.EXPORTS_DIR, config.LOGS_DIR]:
-        os.makedirs(directory, exist_ok=True)
+    for get_dir in (config.get_temp_dir, config.get_exports_dir, config.get_logs_dir):
+        get_dir()
     logger.info("📁 Directorios de sistema inicializados")
     
     # Cleanup automático de archivos antiguos
     if config.STORAGE_SAVE_FILES:
-        from services.storage_provider import get_storage_provider
         storage = get_storage_provider()
         cleanup_count = storage.cleanup_old_files(config.STORAGE_CLEANUP_DAYS)
         if cleanup_count > 0:
             logger.info(f"🧺 Limpieza: {cleanup_count} archivo(s) antiguo(s) eliminado(s)")
+    
+    # Conexión MCP y sesiones en segundo plano: el servidor acepta webhooks mientras tanto
+    app.state.warmup_task = asyncio.create_task(agent.warmup(config.WARMUP_PHONE_NUMBERS))
 
 app.add_middleware(
     CORSMiddleware,
@@ -48,6 +55,59 @@ app.add_middleware(
 agent = EvoDataAgent()
 whatsapp = WhatsAppService()
 
+# Mensajes fijos al usuario (constantes de módulo, no se reconstruyen por request)
+MSG_AUDIO_ERROR = "Lo siento, no pude procesar tu audio. ¿Podrías intentar de nuevo o escribir tu mensaje?"
+MSG_AGENT_ERROR = "Tuve un problema al procesar tu solicitud. Por favor intenta de nuevo."
+MSG_UNEXPECTED_ERROR = "Ocurrió un error inesperado. Por favor intenta de nuevo."
+
+# Tipos de mensaje soportados (lookup O(1), evaluados antes de cualquier otro trabajo)
+_TEXT_MESSAGE_TYPES = frozenset({"conversation", "extendedTextMessage"})
+_AUDIO_MESSAGE_TYPES = frozenset({"audioMessage", "audio"})
+
+@lru_cache(maxsize=64)
+def _is_message_event(event: str) -> bool:
+    """Eventos de mensajes (messages.upsert, MESSAGES_UPSERT, ...): lowercase una sola vez, cacheado por nombre"""
+    event_lower = event.lower()
+    return "messages" in event_lower or "upsert" in event_lower
+
+# Tamaño de bloque para decodificar base64 (múltiplo de 4: cada bloque decodifica por separado)
+_B64_DECODE_CHUNK = 64 * 1024
+
+def _write_base64_file(data_b64: str, path: Path):
+    """
+    Decodifica base64 por bloques directo al archivo, sin materializar todos los bytes en memoria.
+    Quita antes todo espacio en blanco (base64 partido en líneas estilo MIME): los bloques
+    deben alinearse a grupos de 4 caracteres.
+    """
+    data_b64 = "".join(data_b64.split())
+    with open(path, "wb") as f:
+        for i in range(0, len(data_b64), _B64_DECODE_CHUNK):
+            f.write(base64.b64decode(data_b64[i:i + _B64_DECODE_CHUNK]))
+
+# IDs de mensajes ya procesados -> instante (monotonic) en que se vieron
+_seen_messages: "OrderedDict[str, float]" = OrderedDict()
+
+def _is_duplicate_message(message_id: Optional[str]) -> bool:
+    """
+    Registra el mensaje y retorna True si ya se procesó dentro del TTL.
+    Evita repetir Runner.run + envíos a EvolutionAPI en reintentos del webhook.
+    """
+    if not message_id or config.WEBHOOK_DEDUP_TTL <= 0:
+        return False
+    
+    now = time.monotonic()
+    # Purgar expirados: el orden de inserción es el orden temporal
+    while _seen_messages:
+        seen_at = next(iter(_seen_messages.values()))
+        if now - seen_at < config.WEBHOOK_DEDUP_TTL and len(_seen_messages) < config.WEBHOOK_DEDUP_MAX_ENTRIES:
+            break
+        _seen_messages.popitem(last=False)
+    
+    if message_id in _seen_messages:
+        return True
+    _seen_messages[message_id] = now
+    return False
+
 @app.post("/webhook/evolution")
 async def handle_webhook(
     request: Request,
@@ -55,25 +115,24 @@ async def handle_webhook(
 ):
     """Procesador principal de Webhooks (Máxima Flexibilidad)"""
     try:
-        body = await request.json()
+        body = orjson.loads(await request.body())
     except Exception:
         return {"status": "invalid_json"}
 
+    # Solo procesar mensajes (evitar ruidos de conexión/presencia) antes de extraer nada
+    event = body.get("event")
+    if event and not _is_message_event(event):
+        return {"status": "ignored_event", "event": event}
+
     # Extraer data de diferentes versiones/eventos
     data = body.get("data") or body
     instance = body.get("instance") or config.EVOLUTION_INSTANCE
-    event = body.get("event")
     
     # Soporte para array de mensajes (v2 standard)
     if isinstance(data, dict) and "messages" in data:
         messages = data.get("messages", [])
         if messages: data = messages[0]
 
-    # Solo procesar mensajes (evitar ruidos de conexión/presencia)
-    is_message_event = event and ("messages" in event or "MESSAGES" in event or "upsert" in event.lower())
-    if event and not is_message_event:
-        return {"status": "ignored_event", "event": event}
-
     key = data.get("key", {})
     from_me = key.get("fromMe", False)
     if from_me: return {"status": "ignored_self"}
@@ -81,20 +140,30 @@ async def handle_webhook(
     remote_jid = key.get("remoteJid")
     if not remote_jid: return {"status": "no_jid"}
     
-    phone_number = whatsapp.normalize_phone_number(remote_jid)
+    # Descartar tipos no soportados (reacciones, stickers...) antes de dedup/normalización
     msg_type = data.get("messageType")
+    if msg_type not in _TEXT_MESSAGE_TYPES and msg_type not in _AUDIO_MESSAGE_TYPES:
+        logger.debug("Tipo de mensaje no soportado: %s", msg_type)
+        return {"status": "unsupported_type"}
+    
+    message_id = key.get("id")
+    if _is_duplicate_message(f"{remote_jid}:{message_id}" if message_id else None):
+        logger.info("🔁 Mensaje duplicado ignorado: %s", message_id)
+        return {"status": "duplicate"}
+    
+    phone_number = whatsapp.normalize_phone_number(remote_jid)
     
-    logger.info(f"📩 Evento: {event or 'legacy'} | Instancia: {instance} | Tipo: {msg_type} | De: {phone_number}")
+    logger.info("📩 Evento: %s | Instancia: %s | Tipo: %s | De: %s", event or 'legacy', instance, msg_type, phone_number)
 
     # Orquestación de tareas en segundo plano
-    if msg_type in ["conversation", "extendedTextMessage"]:
+    if msg_type in _TEXT_MESSAGE_TYPES:
         msg_content = data.get("message", {})
         text = msg_content.get("conversation") or (msg_content.get("extendedTextMessage") or {}).get("text", "")
         if text:
             background_tasks.add_task(process_chat_flow, phone_number, text)
             return {"status": "processing"}
             
-    elif msg_type in ["audioMessage", "audio"]:
+    elif msg_type in _AUDIO_MESSAGE_TYPES:
         message = data.get("message", {})
         audio_msg = message.get("audioMessage") or message.get("audio") or {}
         audio_url = audio_msg.get("url")
@@ -123,96 +192,102 @@ async def process_chat_flow(
     full_data: dict = None
 ):
     """Flujo completo: Procesamiento -> Agente -> WhatsApp"""
+    voice_task = None
     try:
         audio_path = None
         if is_voice:
-            audio_path = Path(config.TEMP_DIR) / f"voice_{uuid.uuid4().hex}.mp3"
+            audio_path = Path(config.get_temp_dir()) / f"voice_{uuid.uuid4().hex}.mp3"
             success = False
             
             # 1. Recuperación de Media (Estrategia única vía Evolution API)
-            logger.info(f"🎤 Solicitando media vía Evolution API (ID: {msg_key.get('id') if msg_key else 'N/A'})...")
+            logger.info("🎤 Solicitando media vía Evolution API (ID: %s)...", msg_key.get('id') if msg_key else 'N/A')
             base64_audio = await whatsapp.fetch_media(
                 msg_key, 
                 instance_name=instance_name,
                 message_data=full_data
             )
             if base64_audio:
-                import base64
-                with open(audio_path, "wb") as f:
-                    f.write(base64.b64decode(base64_audio))
+                # Decodificación en un hilo: notas de voz largas no bloquean el event loop
+                await asyncio.to_thread(_write_base64_file, base64_audio, audio_path)
                 success = True
-                logger.info(f"✅ Audio obtenido y descifrado")
+                logger.info("✅ Audio obtenido y descifrado")
 
             if not success:
                 audio_path = None
                 logger.error(f"❌ Fallo total al recuperar audio para {phone_number}")
-                await whatsapp.send_text_message(
-                    phone_number, 
-                    "Lo siento, no pude procesar tu audio. ¿Podrías intentar de nuevo o escribir tu mensaje?"
-                )
+                whatsapp.enqueue_text_message(phone_number, MSG_AUDIO_ERROR)
                 return
 
         # 2. Procesamiento del Agente
-        logger.info(f"🤖 Procesando solicitud de {phone_number} (voice={is_voice})")
+        logger.info("🤖 Procesando solicitud de %s (voice=%s)", phone_number, is_voice)
         result = await agent.process_message(
             text, 
             phone_number=phone_number, 
             is_voice=is_voice, 
             audio_path=str(audio_path) if audio_path else None
         )
+        # Síntesis de voz en curso (usuario envió voz): se envía al final o se descarta en el finally
+        voice_task = result.get("voice_task")
         
         # 3. Respuesta
         if result.get("success"):
-            logger.info(f"📤 Respuesta lista para {phone_number}")
-            
-            # Prioridad: Si hay nota de voz, enviarla primero (usuario envió voz)
-            voice_note = result.get("voice_note")
-            if voice_note:
-                await whatsapp.send_voice_note(phone_number, voice_note)
-                # Limpiar archivo temporal de voz
-                Path(voice_note).unlink(missing_ok=True)
-                logger.debug(f"🗑️ Audio temporal eliminado: {voice_note}")
+            logger.info("📤 Respuesta lista para %s", phone_number)
             
-            # Enviar texto y archivos (siempre, como complemento o principal)
+            # Enviar texto y archivos primero: no esperan a la síntesis de voz
             await whatsapp.send_message_with_response(phone_number, result)
             
-            # Borrar archivos si STORAGE_SAVE_FILES=false
-            if not config.STORAGE_SAVE_FILES:
+            # Borrar archivos si STORAGE_SAVE_FILES=false, salvo que se hayan enviado enlaces (url/both):
+            # esos se conservan para que el enlace funcione y los limpia STORAGE_CLEANUP_DAYS
+            if not config.STORAGE_SAVE_FILES and not config.FILE_DELIVERY_LINKS:
                 files = result.get("files", [])
                 for file_path in files:
                     try:
                         Path(file_path).unlink(missing_ok=True)
-                        logger.debug(f"🗑️ Archivo temporal eliminado: {file_path}")
+                        logger.debug("🗑️ Archivo temporal eliminado: %s", file_path)
                     except Exception as e:
                         logger.warning(f"⚠️ No se pudo borrar {file_path}: {e}")
+
+            # Nota de voz como seguimiento (usuario envió voz): el TTS corrió mientras se enviaba el texto
+            if voice_task:
+                pending, voice_task = voice_task, None
+                await _send_voice_followup(phone_number, pending)
         else:
             error_msg = result.get("error", "Error desconocido")
             logger.error(f"❌ Error del agente: {error_msg}")
-            await whatsapp.send_text_message(
-                phone_number, 
-                "Tuve un problema al procesar tu solicitud. Por favor intenta de nuevo."
-            )
+            whatsapp.enqueue_text_message(phone_number, MSG_AGENT_ERROR)
         
         # Cleanup
         if audio_path and audio_path.exists(): 
             audio_path.unlink()
-            logger.info(f"🗑️ Temporales limpios")
+            logger.info("🗑️ Temporales limpios")
         
     except Exception as e:
-        from utils.logger import log_error_with_context
         log_error_with_context(logger, e, {"phone_number": phone_number, "flow": "voice" if is_voice else "text"})
-        try:
-            await whatsapp.send_text_message(phone_number, "Ocurrió un error inesperado. Por favor intenta de nuevo.")
-        except: pass
+        whatsapp.enqueue_text_message(phone_number, MSG_UNEXPECTED_ERROR)
+    finally:
+        # Un error antes del seguimiento no deja la tarea TTS huérfana ni su audio en temp/
+        discard_voice_task(voice_task)
+
+async def _send_voice_followup(phone_number: str, voice_task: "asyncio.Task") -> None:
+    """Espera la síntesis TTS en curso y envía la nota de voz, limpiando el audio temporal"""
+    voice_note = await voice_task
+    if not voice_note:
+        return
+    try:
+        await whatsapp.send_voice_note(phone_number, voice_note)
+    finally:
+        Path(voice_note).unlink(missing_ok=True)
+        logger.debug("🗑️ Audio temporal eliminado: %s", voice_note)
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Limpieza de recursos"""
     await whatsapp.close()
+    await agent.tts.close()
     logger.info("🔌 Conexiones cerradas")
 
 @app.get("/health")
-def health():
+def health() -> Dict[str, Any]:
     return {"status": "ok", "agent": config.AGENT_NAME}
 
 if __name__ == "__main__":